@@ -1,18 +1,170 @@
 # coding: utf-8
 
-from django.contrib import admin
+import csv
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.core.paginator import Paginator
+from django.db import connection
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
 from autocomplete_light import modelform_factory
-from .models import EducationalModule, EducationalModuleEnrollment
+from .models import EducationalModule, EducationalModuleEnrollment, EducationalModuleEnrollmentReason, \
+    EducationalModuleEnrollmentType, EducationalModuleProgressRollup
+from .utils import bulk_enroll_users, parse_usernames
+
+
+class BulkEnrollForm(forms.Form):
+    usernames = forms.CharField(label=_(u'Логины пользователей'), widget=forms.Textarea, required=False,
+                                help_text=_(u'По одному на строку'))
+    csv_file = forms.FileField(label=_(u'csv-файл'), required=False, help_text=_(u'Логины в первой колонке'))
+    enrollment_type = forms.ModelChoiceField(label=_(u'Вариант прохождения модуля'), required=False,
+                                             queryset=EducationalModuleEnrollmentType.objects.none())
+    payment_type = forms.ChoiceField(label=_(u'Способ платежа'), required=False,
+                                     choices=[('', '')] + EducationalModuleEnrollmentReason.PAYMENT_TYPE.CHOICES)
+    payment_order_id = forms.CharField(label=_(u'Номер договора'), required=False, max_length=64)
+    is_paid = forms.BooleanField(label=_(u'Прохождение оплачено'), required=False)
+
+    def __init__(self, module, *args, **kwargs):
+        super(BulkEnrollForm, self).__init__(*args, **kwargs)
+        self.fields['enrollment_type'].queryset = EducationalModuleEnrollmentType.objects.filter(module=module)
+
+    def clean(self):
+        cleaned_data = super(BulkEnrollForm, self).clean()
+        if cleaned_data.get('payment_type') == EducationalModuleEnrollmentReason.PAYMENT_TYPE.YAMONEY and \
+                cleaned_data.get('payment_order_id'):
+            raise forms.ValidationError(_(u'Номер заказа яндекс-кассы уникален для каждой записи, '
+                                          u'его нельзя указать при массовой записи'))
+        return cleaned_data
+
+    def get_usernames(self):
+        usernames = parse_usernames(self.cleaned_data['usernames'].encode('utf-8').splitlines())
+        if self.cleaned_data['csv_file']:
+            usernames.extend(parse_usernames(self.cleaned_data['csv_file'].read().splitlines()))
+        return usernames
 
 
 class EducationalModuleAdmin(admin.ModelAdmin):
     filter_horizontal = ('courses', )
+    actions = ['bulk_enroll']
+
+    def bulk_enroll(self, request, queryset):
+        if queryset.count() != 1:
+            self.message_user(request, _(u'Выберите один модуль'), level=messages.ERROR)
+            return
+        module = queryset.get()
+        if 'apply' in request.POST:
+            form = BulkEnrollForm(module, request.POST, request.FILES)
+            if form.is_valid():
+                stats = bulk_enroll_users(
+                    module, form.get_usernames(),
+                    enrollment_type=form.cleaned_data['enrollment_type'],
+                    payment_type=form.cleaned_data['payment_type'] or None,
+                    payment_order_id=form.cleaned_data['payment_order_id'] or None,
+                    is_paid=form.cleaned_data['is_paid'],
+                )
+                self.message_user(request, _(u'Записано: %(created)s, снова активировано: %(reactivated)s, '
+                                             u'уже были записаны: %(existing)s, '
+                                             u'не найдено пользователей: %(unknown)s') % {
+                    'created': stats['created'],
+                    'reactivated': stats['reactivated'],
+                    'existing': stats['existing'],
+                    'unknown': len(stats['unknown']),
+                })
+                return
+        else:
+            form = BulkEnrollForm(module)
+        return render(request, 'admin/plp_edmodule/bulk_enroll.html', {
+            'title': _(u'Массовая запись на модуль'),
+            'module': module,
+            'form': form,
+            'opts': self.model._meta,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+    bulk_enroll.short_description = _(u'Массовая запись пользователей на модуль')
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    пагинатор для больших таблиц: для выборки без фильтров в postgresql число строк берется
+    из статистики планировщика (pg_class.reltuples) вместо COUNT(*)
+    """
+    exact_count_limit = 10000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where and connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [query.model._meta.db_table])
+            row = cursor.fetchone()
+            if row and row[0] > self.exact_count_limit:
+                return int(row[0])
+        return super(EstimatedCountPaginator, self).count
 
 
 class EducationalModuleEnrollmentAdmin(admin.ModelAdmin):
-    list_display = ('user', 'module', 'is_active')
+    list_display = ('user', 'module', 'is_active', 'is_paid', 'is_graduated')
+    list_filter = ('is_active', 'is_paid', 'is_graduated', 'module')
+    list_select_related = ('user', 'module')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     form = modelform_factory(EducationalModuleEnrollment, exclude=[])
+    actions = ['make_active', 'make_inactive', 'make_paid', 'make_unpaid', 'make_graduated']
+
+    def _update(self, request, queryset, **fields):
+        """
+        изменение выбранных записей одним UPDATE; сигналы и письма при этом не отправляются
+        """
+        count = queryset.update(updated_at=timezone.now(), **fields)
+        self.message_user(request, _(u'Изменено записей: %(count)s') % {'count': count})
+
+    def make_active(self, request, queryset):
+        self._update(request, queryset.filter(is_active=False), is_active=True)
+    make_active.short_description = _(u'Активировать выбранные записи')
+
+    def make_inactive(self, request, queryset):
+        self._update(request, queryset.filter(is_active=True), is_active=False)
+    make_inactive.short_description = _(u'Деактивировать выбранные записи')
+
+    def make_paid(self, request, queryset):
+        self._update(request, queryset.filter(is_paid=False), is_paid=True)
+    make_paid.short_description = _(u'Отметить как оплаченные')
+
+    def make_unpaid(self, request, queryset):
+        self._update(request, queryset.filter(is_paid=True), is_paid=False)
+    make_unpaid.short_description = _(u'Отметить как неоплаченные')
+
+    def make_graduated(self, request, queryset):
+        self._update(request, queryset.filter(is_graduated=False), is_graduated=True)
+    make_graduated.short_description = _(u'Отметить как завершенные')
+
+
+class EducationalModuleProgressRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'module', 'course_id', 'started', 'passing', 'finished')
+    list_filter = ('module', 'day')
+    list_select_related = ('module', )
+    date_hierarchy = 'day'
+    actions = ['export_csv']
+
+    def has_add_permission(self, request):
+        return False
+
+    def export_csv(self, request, queryset):
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="edmodule_progress.csv"'
+        writer = csv.writer(response)
+        writer.writerow(['day', 'module', 'course_id', 'started', 'passing', 'finished'])
+        for row in queryset.order_by('module__code', 'course_id', 'day').values_list(
+                'day', 'module__code', 'course_id', 'started', 'passing', 'finished').iterator():
+            writer.writerow(row)
+        return response
+    export_csv.short_description = _(u'Выгрузить в csv')
 
 
 admin.site.register(EducationalModule, EducationalModuleAdmin)
 admin.site.register(EducationalModuleEnrollment, EducationalModuleEnrollmentAdmin)
+admin.site.register(EducationalModuleProgressRollup, EducationalModuleProgressRollupAdmin)
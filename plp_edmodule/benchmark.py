@@ -0,0 +1,454 @@
+# coding: utf-8
+
+"""
+воспроизводимые замеры производительности модуля: генерация данных по seed, локальная замена edx
+для /api/extended/edmoduleprogress с настраиваемыми задержкой и долей ошибок и прогон сценариев
+с записью времени, числа запросов к бд и пикового расхода памяти. Результат - словарь,
+пригодный для сериализации в json и сравнения между коммитами
+"""
+
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import requests
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, models
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import parse_qs, urlparse
+from plp.models import Course, CourseSession, University, User
+from .models import EducationalModule, EducationalModuleEnrollment, EducationalModuleProgress, \
+    EducationalModuleCourseProgress, EducationalModuleNotification
+from .notifications import EdmoduleCourseStartsEmails, EdmoduleCourseEnrollEndsEmails
+from .utils import EDX_POOL_MAXSIZE, edx_circuit_breaker, get_edx_session, sync_enrollments_progress, \
+    update_module_enrollment_progress
+from .views import edmodule_enroll, module_page, update_context_with_modules
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+BENCH_PREFIX = 'bench'
+SCENARIOS = ['edmodule_enroll', 'module_page', 'b_modules', 'update_module_enrollment_progress',
+             'sync_enrollments_progress', 'course_starts_emails', 'course_enroll_ends_emails', 'enroll_stress']
+
+
+class FakeEdxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    ответы на /api/extended/edmoduleprogress в формате edx: {id сессии: {passed, percent}}
+    """
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path.rstrip('/') != '/api/extended/edmoduleprogress':
+            return self._respond(404, {'detail': 'not found'})
+        with server.lock:
+            server.requests_count += 1
+            failed = server.rng.random() < server.error_rate
+            values = [(server.rng.random(), server.rng.random()) for _ in range(64)]
+        if failed:
+            with server.lock:
+                server.errors_count += 1
+            return self._respond(500, {'detail': 'stand-in error'})
+        query = parse_qs(url.query)
+        course_ids = [i for i in ','.join(query.get('course_id', [])).split(',') if i]
+        data = {}
+        for n, course_id in enumerate(course_ids):
+            passed, percent = values[n % len(values)]
+            data[course_id] = {'passed': passed < server.pass_rate, 'percent': round(percent, 2)}
+        self._respond(200, data)
+
+    def _respond(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEdxServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    локальная замена edx, работающая в фоновом потоке
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, pass_rate=0.3, seed=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeEdxHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pass_rate = pass_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_count = 0
+        self.errors_count = 0
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        return {'requests': self.requests_count, 'errors': self.errors_count,
+                'latency': self.latency, 'error_rate': self.error_rate}
+
+
+class _StandInAdapter(requests.adapters.HTTPAdapter):
+    """
+    адаптер, перенаправляющий запросы к edx на локальную замену с сохранением пути и параметров
+    """
+    def __init__(self, base_url, **kwargs):
+        self.base_url = base_url
+        super(_StandInAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.url = '{}{}{}'.format(self.base_url, url.path, '?' + url.query if url.query else '')
+        return super(_StandInAdapter, self).send(request, **kwargs)
+
+
+@contextmanager
+def edx_stand_in(server):
+    """
+    на время блока все запросы общей сессии edx уходят на server
+    """
+    session = get_edx_session()
+    adapters = session.adapters.copy()
+    adapter = _StandInAdapter(server.url, pool_maxsize=EDX_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    edx_circuit_breaker.record_success()
+    try:
+        yield server
+    finally:
+        session.adapters = adapters
+        adapter.close()
+        edx_circuit_breaker.record_success()
+
+
+def _required_values(model, fields, token):
+    """
+    значения для обязательных полей модели, не переданных явно, чтобы генератор
+    не зависел от набора полей моделей plp
+    """
+    values = {}
+    for f in model._meta.fields:
+        if f.name in fields or f.auto_created or f.null or f.has_default() or f.rel or \
+                getattr(f, 'auto_now', False) or getattr(f, 'auto_now_add', False):
+            continue
+        if f.choices:
+            values[f.name] = f.choices[0][0]
+        elif isinstance(f, models.FileField):
+            values[f.name] = ''
+        elif isinstance(f, (models.CharField, models.TextField)):
+            values[f.name] = '{}-{}'.format(BENCH_PREFIX, token)[:f.max_length or None]
+        elif isinstance(f, models.BooleanField):
+            values[f.name] = False
+        elif isinstance(f, (models.IntegerField, models.FloatField, models.DecimalField)):
+            values[f.name] = 0
+        elif isinstance(f, models.DateTimeField):
+            values[f.name] = timezone.now()
+        elif isinstance(f, models.DateField):
+            values[f.name] = timezone.now().date()
+    return values
+
+
+def build_instance(model, token, **fields):
+    """
+    несохраненный объект модели с переданными полями; обязательные поля, не переданные явно,
+    заполняются значениями с token (используется генератором данных и тестами)
+    """
+    fields.update(_required_values(model, fields, token))
+    return model(**fields)
+
+
+def new_dataset():
+    """
+    id объектов, созданных генератором; заполняется по мере создания, так что удалить
+    можно и данные прерванной генерации
+    """
+    return {'universities': [], 'courses': [], 'modules': [], 'users': []}
+
+
+def cleanup_dataset(created):
+    """
+    удаление только тех объектов, которые создал генератор
+    """
+    EducationalModule.objects.filter(id__in=created['modules']).delete()
+    Course.objects.filter(id__in=created['courses']).delete()
+    University.objects.filter(id__in=created['universities']).delete()
+    for i in range(0, len(created['users']), 1000):
+        User.objects.filter(id__in=created['users'][i:i + 1000]).delete()
+
+
+def seed_dataset(created, modules=20, courses=50, users=1000, seed=0):
+    """
+    генерация данных: modules модулей из 2-6 курсов, courses курсов с одной начавшейся сессией,
+    users пользователей с 1-3 записями на модули и сохраненным прогрессом по курсам.
+    При одинаковом seed структура данных совпадает; имена получают уникальный для прогона префикс.
+    id созданных объектов записываются в created
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    prefix = '{}-{}'.format(BENCH_PREFIX, uuid.uuid4().hex[:8])
+    university = build_instance(University, 'university', slug='{}-university'.format(prefix),
+                                title='Benchmark')
+    university.save()
+    created['universities'].append(university.id)
+    course_objects = []
+    for i in range(courses):
+        course = build_instance(Course, 'course-{}'.format(i), slug='{}-course-{}'.format(prefix, i),
+                                title='Benchmark course {}'.format(i), university=university)
+        course.save()
+        created['courses'].append(course.id)
+        build_instance(CourseSession, 'session-{}'.format(i), course=course,
+                       slug='{}-session'.format(BENCH_PREFIX),
+                       datetime_starts=now - timezone.timedelta(days=rng.randint(1, 60)),
+                       datetime_ends=now + timezone.timedelta(days=rng.randint(30, 120))).save()
+        course_objects.append(course)
+
+    module_objects = []
+    for i in range(modules):
+        module = build_instance(EducationalModule, 'module-{}'.format(i), code='{}-module-{}'.format(prefix, i),
+                                title='Benchmark module {}'.format(i), about='Benchmark module {}'.format(i))
+        module.save()
+        created['modules'].append(module.id)
+        module.courses.add(*rng.sample(course_objects, min(rng.randint(2, 6), len(course_objects))))
+        module_objects.append(module)
+
+    User.objects.bulk_create([
+        build_instance(User, 'user-{}'.format(i), username='{}-user-{}'.format(prefix, i),
+                       email='{}-user-{}@example.com'.format(prefix, i))
+        for i in range(users)
+    ])
+    user_ids = list(User.objects.filter(username__startswith='{}-user-'.format(prefix)).order_by(
+        'id').values_list('id', flat=True))
+    created['users'].extend(user_ids)
+    EducationalModuleEnrollment.objects.bulk_create([
+        EducationalModuleEnrollment(user_id=user_id, module=module, is_active=True)
+        for user_id in user_ids
+        for module in rng.sample(module_objects, min(rng.randint(1, 3), len(module_objects)))
+    ])
+
+    started = EducationalModule.objects.started_course_ids([m.id for m in module_objects])
+    enrollments = list(EducationalModuleEnrollment.objects.filter(
+        module__in=module_objects).order_by('id').values_list('id', 'module_id'))
+    EducationalModuleProgress.objects.bulk_create([EducationalModuleProgress(enrollment_id=i) for i, _ in enrollments])
+    rows = []
+    for enrollment_id, module_id in enrollments:
+        for course_id, session_id in sorted(started[module_id].items()):
+            grade = round(rng.random(), 2)
+            rows.append(EducationalModuleCourseProgress(
+                enrollment_id=enrollment_id, course_id=course_id, session_id=session_id, passed=grade > 0.7,
+                grade=grade, data={'passed': grade > 0.7, 'percent': grade}))
+    EducationalModuleCourseProgress.objects.bulk_create(rows, batch_size=1000)
+    return {'modules': modules, 'courses': courses, 'users': users, 'enrollments': len(enrollments),
+            'course_progress': len(rows), 'seed': seed, 'prefix': prefix}
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def _summary(values, digits=3):
+    return {
+        'min': round(min(values), digits),
+        'median': round(_percentile(values, 0.5), digits),
+        'p95': round(_percentile(values, 0.95), digits),
+        'max': round(max(values), digits),
+    }
+
+
+def _measure(func):
+    """
+    один прогон: время, запросы к бд, время бд и пиковый прирост памяти (кб). Без tracemalloc
+    (python 2) используется прирост максимального rss процесса, он заметен только при росте пика
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    else:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with CaptureQueriesContext(connection) as queries:
+        started = time.time()
+        func()
+        seconds = time.time() - started
+    if tracemalloc is not None:
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    else:
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    db_seconds = sum(float(q.get('time') or 0) for q in queries.captured_queries)
+    return seconds, len(queries.captured_queries), db_seconds, peak_kb
+
+
+def run_scenario(name, func, args_list):
+    """
+    прогон сценария для каждого набора аргументов и сводка по прогонам
+    """
+    runs = [_measure(lambda: func(*args)) for args in args_list]
+    if not runs:
+        return {'name': name, 'runs': 0}
+    return {
+        'name': name,
+        'runs': len(runs),
+        'wall_ms': _summary([i[0] * 1000 for i in runs]),
+        'queries': _summary([i[1] for i in runs], 0),
+        'db_ms': _summary([i[2] * 1000 for i in runs]),
+        'peak_memory_kb': round(max(i[3] for i in runs), 1),
+    }
+
+
+def enroll_stress_check(user, module, threads=8, operations=25):
+    """
+    одновременные запись и отписка одного пользователя из нескольких потоков:
+    после прогона должна остаться ровно одна запись и ни одной ошибки
+    """
+    EducationalModuleEnrollment.objects.filter(user=user, module=module).delete()
+    errors = []
+    start = threading.Event()
+
+    def worker(n):
+        rng = random.Random(n)
+        start.wait()
+        try:
+            for _ in range(operations):
+                EducationalModuleEnrollment.objects.set_active(user, module, rng.random() < 0.5)
+        except Exception as exc:
+            errors.append(repr(exc))
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=worker, args=(n, )) for n in range(threads)]
+    for w in workers:
+        w.start()
+    started = time.time()
+    start.set()
+    for w in workers:
+        w.join()
+    seconds = time.time() - started
+    EducationalModuleEnrollment.objects.set_active(user, module, True)
+    rows = EducationalModuleEnrollment.objects.filter(user=user, module=module).count()
+    return {
+        'name': 'enroll_stress',
+        'threads': threads,
+        'operations': threads * operations,
+        'seconds': round(seconds, 3),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'rows': rows,
+        'ok': not errors and rows == 1,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(created, repeat=20, seed=0, latency=0.05, error_rate=0.0, scenarios=None, dataset=None):
+    """
+    прогон сценариев на сгенерированных данных (created - id из seed_dataset) с локальной заменой edx
+    """
+    scenarios = scenarios or SCENARIOS
+    rng = random.Random(seed)
+    factory = RequestFactory()
+    modules = list(EducationalModule.objects.filter(id__in=created['modules']).order_by('id'))
+    users = list(User.objects.filter(id__in=created['users']).order_by('id'))
+    enrollments = list(EducationalModuleEnrollment.objects.filter(module__in=modules).select_related(
+        'user', 'module').order_by('id'))
+    sessions = list(CourseSession.objects.filter(course__education_modules__in=modules).distinct().order_by('id'))
+    sample = lambda items: [rng.choice(items) for _ in range(repeat)] if items else []
+    results = []
+    server = FakeEdxServer(latency=latency, error_rate=error_rate, seed=seed).start()
+    try:
+        with edx_stand_in(server), override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            if 'edmodule_enroll' in scenarios:
+                def enroll(user, module):
+                    for is_active in ('true', 'false'):
+                        request = factory.post('/edmodule/enroll/', {'ed_module_code': module.code,
+                                                                     'is_active': is_active})
+                        request.user = user
+                        edmodule_enroll(request)
+                results.append(run_scenario('edmodule_enroll', enroll,
+                                            [(u, rng.choice(modules)) for u in sample(users)]))
+
+            if 'module_page' in scenarios:
+                def page(module):
+                    request = factory.get('/edmodule/{}/'.format(module.code))
+                    request.user = AnonymousUser()
+                    module_page(request, module.code)
+                results.append(run_scenario('module_page', page, [(m, ) for m in sample(modules)]))
+
+            if 'b_modules' in scenarios:
+                def block(user):
+                    context = {}
+                    update_context_with_modules(context, user)
+                    render_to_string('course/b_modules.html', context)
+                results.append(run_scenario('b_modules', block, [(u, ) for u in sample(users)]))
+
+            if 'update_module_enrollment_progress' in scenarios:
+                results.append(run_scenario('update_module_enrollment_progress', update_module_enrollment_progress,
+                                            [(e, ) for e in sample(enrollments)]))
+
+            if 'sync_enrollments_progress' in scenarios:
+                enrollments_qs = EducationalModuleEnrollment.objects.filter(module__in=modules)
+                results.append(run_scenario('sync_enrollments_progress', sync_enrollments_progress,
+                                            [(enrollments_qs, )]))
+
+            for name, cls in (('course_starts_emails', EdmoduleCourseStartsEmails),
+                              ('course_enroll_ends_emails', EdmoduleCourseEnrollEndsEmails)):
+                if name not in scenarios:
+                    continue
+
+                picked = rng.sample(sessions, min(max(repeat // 4, 1), len(sessions)))
+                results.append(run_scenario(name, lambda session, cls=cls: cls(session).send(),
+                                            [(s, ) for s in picked]))
+                EducationalModuleNotification.objects.filter(session__in=picked,
+                                                             kind=cls.notification_kind).delete()
+
+        if 'enroll_stress' in scenarios and users and modules:
+            results.append(enroll_stress_check(users[0], modules[0]))
+    finally:
+        server.stop()
+    logging.info('Educational module benchmark finished: {} scenarios'.format(len(results)))
+    return {
+        'revision': _git_revision(),
+        'created_at': timezone.now().isoformat(),
+        'database': settings.DATABASES['default']['ENGINE'],
+        'dataset': dataset,
+        'params': {'repeat': repeat, 'seed': seed, 'latency': latency, 'error_rate': error_rate},
+        'edx': server.stats(),
+        'results': results,
+    }
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+import json
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+from plp.models import Course
+from .models import EducationalModule, EducationalModuleEnrollmentType, EducationalModuleRatingSummary
+
+CATALOG_CACHE_TTL = getattr(settings, 'EDMODULE_CATALOG_CACHE_TTL', 5 * 60)
+CATALOG_PAGE_SIZE = 20
+CATALOG_MAX_PAGE_SIZE = 100
+CATALOG_VERSION_KEY = 'edmodule_catalog_version'
+
+
+def catalog_version():
+    """
+    версия каталога - счетчик изменений данных. Живет не дольше CATALOG_CACHE_TTL,
+    чтобы учитывались сроки приема оплаты, которые истекают без изменения данных; новый счетчик
+    начинается с текущего времени в миллисекундах, поэтому версии не повторяются
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), CATALOG_CACHE_TTL)
+        version = cache.get(CATALOG_VERSION_KEY) or int(time.time() * 1000)
+    return version
+
+
+def invalidate_catalog():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # счетчика нет (истек или еще не создан) - следующий запрос создаст новый
+        if not cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), CATALOG_CACHE_TTL):
+            cache.incr(CATALOG_VERSION_KEY)
+
+
+def _discounted(price, discount):
+    if price is None:
+        return None
+    return int(round(price * (100 - (discount or 0)) / 100.0))
+
+
+def _active_enrollment_types(module_ids):
+    now = timezone.now()
+    types = EducationalModuleEnrollmentType.objects.filter(module__in=module_ids, active=True).filter(
+        Q(buy_start__isnull=True) | Q(buy_start__lte=now),
+        Q(buy_expiration__isnull=True) | Q(buy_expiration__gte=now.date()),
+    ).order_by('price')
+    result = {}
+    for t in types:
+        result.setdefault(t.module_id, []).append(t)
+    return result
+
+
+def _ratings(module_ids):
+    return dict((s.module_id, {'count': s.count, 'average': s.average, 'histogram': s.histogram})
+                for s in EducationalModuleRatingSummary.objects.filter(module__in=module_ids))
+
+
+def serialize_module(module, enrollment_types, rating):
+    price = _discounted(module.price, module.discount)
+    if price is None and enrollment_types:
+        price = enrollment_types[0].price
+    return {
+        'code': module.code,
+        'title': module.title,
+        'price': module.price,
+        'discount': module.discount,
+        'effective_price': price,
+        'enrollment_types': [{
+            'mode': t.mode,
+            'price': t.price,
+            'buy_start': t.buy_start,
+            'buy_expiration': t.buy_expiration,
+        } for t in enrollment_types],
+        'duration': module.duration,
+        'courses': [{
+            'slug': c.slug,
+            'title': c.title,
+            'university': c.university.slug,
+        } for c in module.courses.all()],
+        'rating': rating or {'count': 0, 'average': None, 'histogram': dict.fromkeys(range(1, 6), 0)},
+    }
+
+
+def build_catalog_page(cursor=0, limit=CATALOG_PAGE_SIZE):
+    """
+    страница каталога модулей после модуля с id = cursor; число запросов не зависит от размера страницы
+    """
+    modules = list(EducationalModule.objects.filter(id__gt=cursor).order_by('id').prefetch_related(
+        Prefetch('courses', queryset=Course.objects.select_related('university'))
+    )[:limit + 1])
+    has_next = len(modules) > limit
+    modules = modules[:limit]
+    ids = [m.id for m in modules]
+    types = _active_enrollment_types(ids) if ids else {}
+    ratings = _ratings(ids) if ids else {}
+    return {
+        'results': [serialize_module(m, types.get(m.id, []), ratings.get(m.id)) for m in modules],
+        'next_cursor': modules[-1].id if has_next else None,
+    }
+
+
+def get_catalog_page_json(version, cursor, limit):
+    """
+    страница каталога в json из кэша; ключ включает версию каталога, так что при изменении данных
+    старые страницы просто перестают запрашиваться
+    """
+    key = 'edmodule_catalog:{}:{}:{}'.format(version, cursor, limit)
+    content = cache.get(key)
+    if content is None:
+        content = json.dumps(build_catalog_page(cursor, limit), cls=DjangoJSONEncoder)
+        cache.set(key, content, CATALOG_CACHE_TTL)
+    return content
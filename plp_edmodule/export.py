@@ -0,0 +1,133 @@
+# coding: utf-8
+
+"""
+потоковая выгрузка записей на модули вместе с прогрессом по курсам и причинами записи.
+Записи читаются порциями по ключу id, так что расход памяти не зависит от объема выгрузки,
+а выгрузку можно продолжить с последнего выгруженного id (after_id)
+"""
+
+import csv
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils import timezone
+from .models import EducationalModuleEnrollment, EducationalModuleProgress, EducationalModuleCourseProgress, \
+    EducationalModuleEnrollmentReason
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'EDMODULE_EXPORT_CHUNK_SIZE', 1000)
+ENROLLMENT_FIELDS = ['id', 'user__username', 'user__email', 'module__code', 'is_active', 'is_paid',
+                     'is_graduated', '_ctime', 'updated_at']
+ENROLLMENT_COLUMNS = ['enrollment_id', 'username', 'email', 'module', 'is_active', 'is_paid', 'is_graduated',
+                      'created_at', 'updated_at']
+REASON_FIELDS = ['payment_type', 'payment_order_id', 'module_enrollment_type_id', 'created_at']
+FORMATS = ('csv', 'jsonl')
+
+
+def get_export_queryset(module_codes=None, date_from=None, date_to=None, payment_type=None):
+    """
+    записи на модули с фильтрами по кодам модулей, дате записи (date_to включительно) и способу платежа
+    """
+    qs = EducationalModuleEnrollment.objects.all()
+    if module_codes:
+        qs = qs.filter(module__code__in=module_codes)
+    if date_from:
+        qs = qs.filter(_ctime__gte=date_from)
+    if date_to:
+        qs = qs.filter(_ctime__lt=date_to + timezone.timedelta(days=1))
+    if payment_type:
+        qs = qs.filter(id__in=EducationalModuleEnrollmentReason.objects.filter(
+            payment_type=payment_type).values('enrollment_id'))
+    return qs
+
+
+def get_course_ids(queryset):
+    """
+    сессии курсов, по которым есть прогресс у выгружаемых записей - колонки выгрузки
+    """
+    return sorted(EducationalModuleCourseProgress.objects.filter(enrollment__in=queryset.values('id')).values_list(
+        'course_id', flat=True).distinct())
+
+
+def iter_enrollments(queryset, after_id=0, chunk_size=None, on_item=None):
+    """
+    записи с прогрессом и причинами записи; на порцию из chunk_size записей - четыре запроса.
+    on_item вызывается для каждой записи (например, для запоминания последнего выгруженного id)
+    """
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    while True:
+        chunk = list(queryset.filter(id__gt=after_id).order_by('id').values(*ENROLLMENT_FIELDS)[:chunk_size])
+        if not chunk:
+            break
+        ids = [i['id'] for i in chunk]
+        after_id = ids[-1]
+        updated = dict(EducationalModuleProgress.objects.filter(enrollment__in=ids).values_list(
+            'enrollment_id', 'updated_at'))
+        progress, reasons = {}, {}
+        for enrollment_id, course_id, passed, grade in EducationalModuleCourseProgress.objects.filter(
+                enrollment__in=ids).values_list('enrollment_id', 'course_id', 'passed', 'grade'):
+            progress.setdefault(enrollment_id, {})[course_id] = {'passed': passed, 'grade': grade}
+        for reason in EducationalModuleEnrollmentReason.objects.filter(enrollment__in=ids).order_by('id').values(
+                'enrollment_id', *REASON_FIELDS):
+            reasons.setdefault(reason.pop('enrollment_id'), []).append(reason)
+        for row in chunk:
+            enrollment_id = row['id']
+            item = dict(zip(ENROLLMENT_COLUMNS, [row[f] for f in ENROLLMENT_FIELDS]))
+            item['progress_updated_at'] = updated.get(enrollment_id)
+            item['progress'] = progress.get(enrollment_id, {})
+            item['reasons'] = reasons.get(enrollment_id, [])
+            if on_item is not None:
+                on_item(item)
+            yield item
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+    return value
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def iter_csv(items, course_ids):
+    """
+    строки csv: по две колонки (passed, grade) на сессию курса, причина записи - последняя по времени
+    """
+    writer = csv.writer(_Echo())
+    header = ENROLLMENT_COLUMNS + ['progress_updated_at'] + REASON_FIELDS
+    for course_id in course_ids:
+        header.extend(['{}:passed'.format(course_id), '{}:grade'.format(course_id)])
+    yield writer.writerow([_csv_value(i) for i in header])
+    for item in items:
+        reason = item['reasons'][-1] if item['reasons'] else {}
+        row = [item[c] for c in ENROLLMENT_COLUMNS] + [item['progress_updated_at']] + \
+              [reason.get(f) for f in REASON_FIELDS]
+        for course_id in course_ids:
+            course = item['progress'].get(course_id, {})
+            row.extend([course.get('passed'), course.get('grade')])
+        yield writer.writerow([_csv_value(i) for i in row])
+
+
+def iter_jsonl(items):
+    """
+    по одному json-объекту на запись, прогресс и причины записи - вложенными объектами
+    """
+    for item in items:
+        yield json.dumps(item, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_enrollments(fmt='csv', module_codes=None, date_from=None, date_to=None, payment_type=None, after_id=0,
+                       chunk_size=None, on_item=None):
+    """
+    генератор строк выгрузки в формате csv или jsonl
+    """
+    queryset = get_export_queryset(module_codes, date_from, date_to, payment_type)
+    items = iter_enrollments(queryset, after_id=after_id, chunk_size=chunk_size, on_item=on_item)
+    if fmt == 'jsonl':
+        return iter_jsonl(items)
+    return iter_csv(items, get_course_ids(queryset))
@@ -0,0 +1,45 @@
+# coding: utf-8
+
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.benchmark import SCENARIOS, cleanup_dataset, new_dataset, run_benchmarks, seed_dataset
+
+
+class Command(BaseCommand):
+    help = u'Замеры производительности образовательных модулей на сгенерированных данных с локальной заменой edx'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modules', type=int, default=20)
+        parser.add_argument('--courses', type=int, default=50)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=20, help=u'Число прогонов каждого сценария')
+        parser.add_argument('--latency', type=float, default=0.05, help=u'Задержка ответа edx, секунд')
+        parser.add_argument('--error-rate', type=float, default=0.0, help=u'Доля ответов edx с ошибкой 500')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, dest='scenarios',
+                            help=u'Сценарий (можно указать несколько раз, по умолчанию - все)')
+        parser.add_argument('--output', help=u'Файл для результатов в json (по умолчанию - stdout)')
+        parser.add_argument('--keep-data', action='store_true', help=u'Не удалять сгенерированные данные')
+        parser.add_argument('--force', action='store_true', help=u'Запуск при выключенном DEBUG')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(u'Benchmark creates and deletes data, use --force to run it with DEBUG off')
+        created = new_dataset()
+        try:
+            dataset = seed_dataset(created, options['modules'], options['courses'], options['users'],
+                                   options['seed'])
+            result = run_benchmarks(created, repeat=options['repeat'], seed=options['seed'],
+                                    latency=options['latency'], error_rate=options['error_rate'],
+                                    scenarios=options['scenarios'], dataset=dataset)
+        finally:
+            if not options['keep_data']:
+                cleanup_dataset(created)
+        output = json.dumps(result, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stdout.write(u'Results written to {}'.format(options['output']))
+        else:
+            self.stdout.write(output)
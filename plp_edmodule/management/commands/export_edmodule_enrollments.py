@@ -0,0 +1,48 @@
+# coding: utf-8
+
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from plp_edmodule.export import FORMATS, export_enrollments
+from plp_edmodule.models import EducationalModuleEnrollmentReason
+
+
+class Command(BaseCommand):
+    help = u'Потоковая выгрузка записей на модули с прогрессом по курсам и причинами записи в csv или jsonl'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', default='csv', choices=FORMATS)
+        parser.add_argument('--module', action='append', dest='modules', help=u'Код модуля (можно несколько)')
+        parser.add_argument('--from', dest='date_from', help=u'Дата записи с (ГГГГ-ММ-ДД)')
+        parser.add_argument('--to', dest='date_to', help=u'Дата записи по (ГГГГ-ММ-ДД), включительно')
+        parser.add_argument('--payment-type',
+                            choices=[i[0] for i in EducationalModuleEnrollmentReason.PAYMENT_TYPE.CHOICES])
+        parser.add_argument('--after-id', type=int, default=0, help=u'Продолжить выгрузку после записи с этим id')
+        parser.add_argument('--chunk-size', type=int)
+        parser.add_argument('--output', help=u'Файл выгрузки (по умолчанию - stdout)')
+
+    def handle(self, *args, **options):
+        dates = {}
+        for key in ('date_from', 'date_to'):
+            dates[key] = parse_date(options[key]) if options[key] else None
+            if options[key] and dates[key] is None:
+                raise CommandError(u'Invalid date: {}'.format(options[key]))
+        state = {'last_id': options['after_id'], 'count': 0}
+
+        def on_item(item):
+            state['last_id'] = item['enrollment_id']
+            state['count'] += 1
+
+        lines = export_enrollments(options['format'], module_codes=options['modules'],
+                                   payment_type=options['payment_type'], after_id=options['after_id'],
+                                   chunk_size=options['chunk_size'], on_item=on_item, **dates)
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
+            # id последней выгруженной записи нужен для продолжения прерванной выгрузки
+            self.stderr.write(u'Exported {} enrollments, last id {} (use --after-id to resume)'.format(
+                state['count'], state['last_id']))
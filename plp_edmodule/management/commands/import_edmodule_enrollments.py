@@ -0,0 +1,60 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.models import EducationalModule, EducationalModuleEnrollmentReason, \
+    EducationalModuleEnrollmentType
+from plp_edmodule.utils import bulk_enroll_users, parse_usernames
+
+
+class Command(BaseCommand):
+    help = u'Массовая запись пользователей на образовательный модуль из csv-файла или списка логинов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('module', help=u'Код модуля')
+        parser.add_argument('csv', nargs='?', help=u'csv-файл, логины в первой колонке')
+        parser.add_argument('--usernames', default='', help=u'Логины через запятую')
+        parser.add_argument('--mode', help=u'Вариант прохождения модуля (mode) для причин записи')
+        parser.add_argument('--payment-type',
+                            choices=[i[0] for i in EducationalModuleEnrollmentReason.PAYMENT_TYPE.CHOICES])
+        parser.add_argument('--order-id', help=u'Номер договора')
+        parser.add_argument('--description', help=u'Комментарий к платежу')
+        parser.add_argument('--paid', action='store_true', help=u'Отметить записи как оплаченные')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        try:
+            module = EducationalModule.objects.get(code=options['module'])
+        except EducationalModule.DoesNotExist:
+            raise CommandError(u'Module "{}" not found'.format(options['module']))
+        enrollment_type = None
+        if options['mode'] is not None:
+            try:
+                enrollment_type = EducationalModuleEnrollmentType.objects.get(module=module, mode=options['mode'])
+            except EducationalModuleEnrollmentType.DoesNotExist:
+                raise CommandError(u'Enrollment type "{}" not found for module "{}"'.format(
+                    options['mode'], module.code))
+
+        usernames = parse_usernames(options['usernames'].split(','))
+        if options['csv']:
+            with open(options['csv'], 'rb') as f:
+                usernames.extend(parse_usernames(f))
+        if not usernames:
+            raise CommandError(u'No usernames given')
+        if options['payment_type'] == EducationalModuleEnrollmentReason.PAYMENT_TYPE.YAMONEY and \
+                options['order_id'] and len(set(usernames)) > 1:
+            raise CommandError(u'Yandex.Kassa order id is unique per enrollment, '
+                               u'it can not be used with --payment-type yamoney for several users')
+
+        stats = bulk_enroll_users(
+            module, usernames,
+            enrollment_type=enrollment_type,
+            payment_type=options['payment_type'],
+            payment_order_id=options['order_id'],
+            payment_descriptions=options['description'],
+            is_paid=options['paid'],
+            chunk_size=options['chunk_size'],
+        )
+        self.stdout.write(u'Created: {created}, reactivated: {reactivated}, already enrolled: {existing}, '
+                          u'unknown users: {unknown_count}'.format(unknown_count=len(stats['unknown']), **stats))
+        for username in stats['unknown']:
+            self.stdout.write(u'Unknown user: {}'.format(username))
@@ -0,0 +1,21 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.models import EducationalModule
+
+
+class Command(BaseCommand):
+    help = u'Пересчет хранимых агрегатов образовательных модулей (длительность, курсы, преподаватели)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('codes', nargs='*', help=u'Коды модулей (по умолчанию - все модули)')
+
+    def handle(self, *args, **options):
+        modules = EducationalModule.objects.all()
+        if options['codes']:
+            modules = modules.filter(code__in=options['codes'])
+        count = 0
+        for module in modules.iterator():
+            module.update_aggregates()
+            count += 1
+        self.stdout.write(u'Updated aggregates for {} modules'.format(count))
@@ -0,0 +1,41 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.models import EducationalModule, EducationalModuleRatingSummary
+
+SUMMARY_FIELDS = ['count', 'total'] + ['rating_{}'.format(i) for i in range(1, 6)]
+
+
+class Command(BaseCommand):
+    help = u'Пересчет сводных рейтингов образовательных модулей или проверка их согласованности с отзывами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('codes', nargs='*', help=u'Коды модулей (по умолчанию - все модули)')
+        parser.add_argument('--check', action='store_true', help=u'Только проверить, ничего не меняя')
+
+    def handle(self, *args, **options):
+        module_ids = None
+        if options['codes']:
+            module_ids = list(EducationalModule.objects.filter(code__in=options['codes']).values_list('id', flat=True))
+        if not options['check']:
+            EducationalModuleRatingSummary.objects.rebuild(module_ids)
+            self.stdout.write(u'Rating summaries rebuilt')
+            return
+
+        computed = EducationalModuleRatingSummary.objects.compute(module_ids)
+        stored = EducationalModuleRatingSummary.objects.all()
+        if module_ids is not None:
+            stored = stored.filter(module__in=module_ids)
+        stored = dict((i['module_id'], i) for i in stored.values('module_id', *SUMMARY_FIELDS))
+        mismatched = 0
+        for module_id in set(computed) | set(stored):
+            expected = computed.get(module_id, dict.fromkeys(SUMMARY_FIELDS, 0))
+            actual = stored.get(module_id, dict.fromkeys(SUMMARY_FIELDS, 0))
+            diff = [f for f in SUMMARY_FIELDS if expected[f] != actual[f]]
+            if diff:
+                mismatched += 1
+                self.stdout.write(u'Module {}: {}'.format(module_id, ', '.join(
+                    u'{} stored {} expected {}'.format(f, actual[f], expected[f]) for f in diff)))
+        if mismatched:
+            raise CommandError(u'{} inconsistent rating summaries'.format(mismatched))
+        self.stdout.write(u'Rating summaries are consistent')
@@ -0,0 +1,53 @@
+# coding: utf-8
+
+import csv
+import itertools
+from django.core.management.base import BaseCommand, CommandError
+from plp_edmodule.models import EducationalModuleEnrollmentReason
+from plp_edmodule.utils import reconcile_payments
+
+ORDER_COLUMNS = ('orderNumber', 'order_number', 'order_id')
+AMOUNT_COLUMNS = ('orderSumAmount', 'amount', 'sum')
+
+
+class Command(BaseCommand):
+    help = u'Сверка выгрузки платежей (банк, яндекс-касса) с причинами записи на модули'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help=u'csv-файл с номерами заказов (и, опционально, суммами)')
+        parser.add_argument('--payment-type', default=EducationalModuleEnrollmentReason.PAYMENT_TYPE.YAMONEY,
+                            choices=[i[0] for i in EducationalModuleEnrollmentReason.PAYMENT_TYPE.CHOICES])
+        parser.add_argument('--delimiter', default=',')
+        parser.add_argument('--dry-run', action='store_true', help=u'Только показать расхождения')
+
+    def handle(self, *args, **options):
+        payments = {}
+        with open(options['file'], 'rb') as f:
+            reader = csv.reader(f, delimiter=options['delimiter'])
+            header = next(reader, None)
+            if header is None:
+                raise CommandError(u'Empty file')
+            order_col = next((header.index(c) for c in ORDER_COLUMNS if c in header), None)
+            amount_col = next((header.index(c) for c in AMOUNT_COLUMNS if c in header), None)
+            if order_col is None:
+                # файл без заголовка: номер заказа в первой колонке
+                order_col = 0
+                reader = itertools.chain([header], reader)
+            for row in reader:
+                if len(row) <= order_col or not row[order_col].strip():
+                    continue
+                amount = None
+                if amount_col is not None and len(row) > amount_col:
+                    try:
+                        amount = float(row[amount_col].replace(',', '.'))
+                    except ValueError:
+                        pass
+                payments[row[order_col].strip()] = amount
+
+        stats = reconcile_payments(payments, options['payment_type'], dry_run=options['dry_run'])
+        self.stdout.write(u'Orders: {total}, matched: {matched}, marked paid: {marked_paid}, '
+                          u'already paid: {already_paid}'.format(**stats))
+        for order_id in stats['missing']:
+            self.stdout.write(u'Missing enrollment reason for order {}'.format(order_id))
+        for order_id, amount, price in stats['amount_mismatch']:
+            self.stdout.write(u'Amount mismatch for order {}: paid {}, expected {}'.format(order_id, amount, price))
@@ -0,0 +1,20 @@
+# coding: utf-8
+
+from django.core.management.base import BaseCommand
+from plp_edmodule.models import EducationalModule
+from plp_edmodule.utils import update_graduation
+
+
+class Command(BaseCommand):
+    help = u'Отметка завершения образовательных модулей по сохраненному прогрессу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('codes', nargs='*', help=u'Коды модулей (по умолчанию - все модули)')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        module_ids = None
+        if options['codes']:
+            module_ids = list(EducationalModule.objects.filter(code__in=options['codes']).values_list('id', flat=True))
+        count = update_graduation(module_ids, chunk_size=options['chunk_size'])
+        self.stdout.write(u'Graduated enrollments: {}'.format(count))
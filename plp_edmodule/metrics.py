@@ -0,0 +1,236 @@
+# coding: utf-8
+
+"""
+метрики модуля: задержки обращений к edx, число запросов к бд и время бд во view, время отправки писем,
+длительность задач. Бэкенд задается настройкой EDMODULE_METRICS_BACKEND: 'memory', 'statsd' или путь
+к классу; по умолчанию метрики не собираются, и обертки сводятся к одной проверке флага
+"""
+
+import bisect
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.module_loading import import_string
+
+METRICS_BACKEND = getattr(settings, 'EDMODULE_METRICS_BACKEND', None)
+METRICS_PREFIX = getattr(settings, 'EDMODULE_METRICS_PREFIX', 'edmodule')
+STATSD_HOST = getattr(settings, 'EDMODULE_STATSD_HOST', '127.0.0.1')
+STATSD_PORT = getattr(settings, 'EDMODULE_STATSD_PORT', 8125)
+HISTOGRAM_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class NullMetrics(object):
+    """
+    бэкенд по умолчанию: ничего не записывает
+    """
+    enabled = False
+
+    def timing(self, name, value, **tags):
+        pass
+
+    def observe(self, name, value, **tags):
+        pass
+
+    def incr(self, name, value=1, **tags):
+        pass
+
+
+class InMemoryMetrics(object):
+    """
+    метрики в памяти процесса: гистограммы (задержки - в мс) и счетчики. Подходит для тестов и
+    замеров; render() отдает текущее состояние в текстовом формате prometheus
+    """
+    enabled = True
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted(tags.items()))
+
+    def observe(self, name, value, **tags):
+        key = self._key(name, tags)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * (len(self.buckets) + 1), 'count': 0, 'sum': 0.0}
+            histogram['buckets'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    timing = observe
+
+    def incr(self, name, value=1, **tags):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def get_histogram(self, name, **tags):
+        return self.histograms.get(self._key(name, tags))
+
+    def get_counter(self, name, **tags):
+        return self.counters.get(self._key(name, tags), 0)
+
+    def render(self):
+        def labels(tags, extra=()):
+            items = list(tags) + list(extra)
+            return '{%s}' % ','.join('%s="%s"' % i for i in items) if items else ''
+
+        def metric(name):
+            return '{}_{}'.format(METRICS_PREFIX, name).replace('.', '_')
+
+        lines = []
+        with self._lock:
+            for (name, tags), value in sorted(self.counters.items()):
+                lines.append('{}_total{} {}'.format(metric(name), labels(tags), value))
+            for (name, tags), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf', ), histogram['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(metric(name), labels(tags, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(metric(name), labels(tags), histogram['sum']))
+                lines.append('{}_count{} {}'.format(metric(name), labels(tags), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(object):
+    """
+    отправка метрик по udp локальному агенту statsd (или statsd_exporter для prometheus);
+    теги передаются в формате dogstatsd. Ошибки отправки игнорируются
+    """
+    enabled = True
+
+    def __init__(self, host=STATSD_HOST, port=STATSD_PORT, prefix=METRICS_PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def _send(self, name, value, kind, tags):
+        line = '{}.{}:{}|{}'.format(self.prefix, name, value, kind)
+        if tags:
+            line += '|#' + ','.join('{}:{}'.format(k, v) for k, v in sorted(tags.items()))
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except (socket.error, IOError):
+            pass
+
+    def timing(self, name, value, **tags):
+        self._send(name, round(value, 3), 'ms', tags)
+
+    def observe(self, name, value, **tags):
+        self._send(name, value, 'h', tags)
+
+    def incr(self, name, value=1, **tags):
+        self._send(name, value, 'c', tags)
+
+
+BACKENDS = {
+    'memory': InMemoryMetrics,
+    'statsd': StatsdMetrics,
+}
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    бэкенд метрик процесса, создается при первом обращении
+    """
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                backend = NullMetrics
+                if METRICS_BACKEND:
+                    try:
+                        backend = BACKENDS.get(METRICS_BACKEND) or import_string(METRICS_BACKEND)
+                    except ImportError:
+                        logging.error('Unknown educational module metrics backend {}'.format(METRICS_BACKEND))
+                _metrics = backend()
+    return _metrics
+
+
+def set_metrics(backend):
+    """
+    замена бэкенда (например, InMemoryMetrics в тестах); None возвращает бэкенд из настроек
+    """
+    global _metrics
+    _metrics = backend
+
+
+class timed(object):
+    """
+    замер длительности блока (with timed(...)) или функции (@timed(...)) в миллисекундах
+    """
+    def __init__(self, name, **tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics = get_metrics()
+        if metrics.enabled:
+            tags = dict(self.tags, status='error' if exc_type else 'ok')
+            metrics.timing(self.name, (time.time() - self.started) * 1000, **tags)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(self.name, **self.tags):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def timed_task(func):
+    """
+    длительность и число запусков задачи celery; ставится под декоратором задачи
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not get_metrics().enabled:
+            return func(*args, **kwargs)
+        with timed('task.duration_ms', task=func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument_view(name):
+    """
+    время ответа, число запросов к бд и время бд для view; запросы считаются только
+    при включенных метриках
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            metrics = get_metrics()
+            if not metrics.enabled:
+                return view(request, *args, **kwargs)
+            started = time.time()
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request, *args, **kwargs)
+            tags = {'view': name, 'status': response.status_code}
+            metrics.timing('view.duration_ms', (time.time() - started) * 1000, **tags)
+            metrics.timing('view.db_ms', sum(float(q.get('time') or 0) for q in queries.captured_queries) * 1000,
+                           **tags)
+            metrics.observe('view.queries', len(queries.captured_queries), **tags)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import jsonfield.fields
+
+
+def backfill_course_progress(apps, schema_editor):
+    EducationalModuleProgress = apps.get_model('plp_edmodule', 'EducationalModuleProgress')
+    EducationalModuleCourseProgress = apps.get_model('plp_edmodule', 'EducationalModuleCourseProgress')
+    CourseSession = apps.get_model('plp', 'CourseSession')
+    # ключ - id сессии в edx, как у CourseSession.get_absolute_slug_v1 (у исторической модели этого метода нет)
+    session_ids = dict(
+        ('course-v1:{}+{}+{}'.format(session.course.university.slug, session.course.slug, session.slug), session.id)
+        for session in CourseSession.objects.select_related('course__university').iterator()
+    )
+    rows = []
+    for progress in EducationalModuleProgress.objects.filter(progress__isnull=False).iterator():
+        for course_id, value in (progress.progress or {}).items():
+            value = value if isinstance(value, dict) else {}
+            try:
+                grade = float(value['percent']) if value.get('percent') is not None else None
+            except (TypeError, ValueError):
+                grade = None
+            rows.append(EducationalModuleCourseProgress(
+                enrollment_id=progress.enrollment_id,
+                course_id=course_id,
+                session_id=session_ids.get(course_id),
+                passed=bool(value.get('passed')),
+                grade=grade,
+                data=value,
+            ))
+        if len(rows) >= 1000:
+            EducationalModuleCourseProgress.objects.bulk_create(rows)
+            rows = []
+    EducationalModuleCourseProgress.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleCourseProgress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('course_id', models.CharField(max_length=255, verbose_name='Id \u0441\u0435\u0441\u0441\u0438\u0438 \u043a\u0443\u0440\u0441\u0430 \u0432 edx')),
+                ('passed', models.BooleanField(default=False, verbose_name='\u041a\u0443\u0440\u0441 \u043f\u0440\u043e\u0439\u0434\u0435\u043d')),
+                ('grade', models.FloatField(null=True, verbose_name='\u041e\u0446\u0435\u043d\u043a\u0430', blank=True)),
+                ('data', jsonfield.fields.JSONField(null=True, verbose_name='\u041f\u0440\u043e\u0433\u0440\u0435\u0441\u0441')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u043f\u043e\u0441\u043b\u0435\u0434\u043d\u0435\u0433\u043e \u043e\u0431\u0440\u0430\u0449\u0435\u043d\u0438\u044f \u043a edx')),
+                ('enrollment', models.ForeignKey(related_name='course_progress', verbose_name='\u0417\u0430\u043f\u0438\u0441\u044c \u043d\u0430 \u043c\u043e\u0434\u0443\u043b\u044c', to='plp_edmodule.EducationalModuleEnrollment')),
+                ('session', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='\u0421\u0435\u0441\u0441\u0438\u044f \u043a\u0443\u0440\u0441\u0430', blank=True, to='plp.CourseSession', null=True)),
+            ],
+            options={
+                'verbose_name': '\u041f\u0440\u043e\u0433\u0440\u0435\u0441\u0441 \u043f\u043e \u043a\u0443\u0440\u0441\u0443 \u043c\u043e\u0434\u0443\u043b\u044f',
+                'verbose_name_plural': '\u041f\u0440\u043e\u0433\u0440\u0435\u0441\u0441 \u043f\u043e \u043a\u0443\u0440\u0441\u0430\u043c \u043c\u043e\u0434\u0443\u043b\u044f',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='educationalmodulecourseprogress',
+            unique_together=set([('enrollment', 'course_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='educationalmodulecourseprogress',
+            index_together=set([('course_id', 'passed')]),
+        ),
+        migrations.RunPython(backfill_course_progress, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='educationalmoduleprogress',
+            name='progress',
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def backfill_aggregates(apps, schema_editor):
+    # длительность считается методом course_weeks курса plp, которого нет у исторических моделей,
+    # поэтому duration_weeks остается пустым до запуска rebuild_edmodule_aggregates
+    EducationalModule = apps.get_model('plp_edmodule', 'EducationalModule')
+    Instructor = apps.get_model('plp', 'Instructor')
+    for module in EducationalModule.objects.all().iterator():
+        courses = list(module.courses.all())
+        EducationalModule.objects.filter(pk=module.pk).update(
+            courses_count=len(courses),
+            courses_slugs=', '.join(c.slug for c in courses),
+        )
+        module.instructors_cache.add(*Instructor.objects.filter(instructor_courses__in=courses).distinct())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0002_educationalmodulecourseprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='courses_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='\u041a\u043e\u043b\u0438\u0447\u0435\u0441\u0442\u0432\u043e \u043a\u0443\u0440\u0441\u043e\u0432', editable=False),
+        ),
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='duration_weeks',
+            field=models.PositiveIntegerField(verbose_name='\u0414\u043b\u0438\u0442\u0435\u043b\u044c\u043d\u043e\u0441\u0442\u044c (\u0432 \u043d\u0435\u0434\u0435\u043b\u044f\u0445)', null=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='courses_slugs',
+            field=models.TextField(default='', verbose_name='\u041a\u043e\u0434\u044b \u043a\u0443\u0440\u0441\u043e\u0432', editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='educationalmodule',
+            name='instructors_cache',
+            field=models.ManyToManyField(related_name='+', verbose_name='\u041f\u0440\u0435\u043f\u043e\u0434\u0430\u0432\u0430\u0442\u0435\u043b\u0438', editable=False, to='plp.Instructor', blank=True),
+        ),
+        migrations.RunPython(backfill_aggregates, migrations.RunPython.noop),
+    ]
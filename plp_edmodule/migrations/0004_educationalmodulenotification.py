@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('plp_edmodule', '0003_educationalmodule_aggregates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleNotification',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=32, verbose_name='\u0422\u0438\u043f \u0440\u0430\u0441\u0441\u044b\u043b\u043a\u0438', choices=[(b'course_starts', b'course_starts'), (b'course_enroll_ends', b'course_enroll_ends')])),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(related_name='+', verbose_name='\u0421\u0435\u0441\u0441\u0438\u044f \u043a\u0443\u0440\u0441\u0430', to='plp.CourseSession')),
+                ('user', models.ForeignKey(related_name='+', verbose_name='\u041f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '\u041e\u0442\u043f\u0440\u0430\u0432\u043b\u0435\u043d\u043d\u043e\u0435 \u0443\u0432\u0435\u0434\u043e\u043c\u043b\u0435\u043d\u0438\u0435 \u043c\u043e\u0434\u0443\u043b\u044f',
+                'verbose_name_plural': '\u041e\u0442\u043f\u0440\u0430\u0432\u043b\u0435\u043d\u043d\u044b\u0435 \u0443\u0432\u0435\u0434\u043e\u043c\u043b\u0435\u043d\u0438\u044f \u043c\u043e\u0434\u0443\u043b\u044f',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='educationalmodulenotification',
+            unique_together=set([('session', 'user', 'kind')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('plp_edmodule', '0004_educationalmodulenotification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('kind', models.CharField(max_length=16, verbose_name='\u0422\u0438\u043f \u043f\u0438\u0441\u044c\u043c\u0430', choices=[(b'enrolled', b'enrolled'), (b'unenrolled', b'unenrolled'), (b'payed', b'payed')])),
+                ('status', models.CharField(default=b'pending', max_length=16, verbose_name='\u0421\u0442\u0430\u0442\u0443\u0441', choices=[(b'pending', b'pending'), (b'sent', b'sent'), (b'failed', b'failed')])),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='\u041f\u043e\u043f\u044b\u0442\u043e\u043a \u043e\u0442\u043f\u0440\u0430\u0432\u043a\u0438')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='\u0412\u0440\u0435\u043c\u044f \u0441\u043b\u0435\u0434\u0443\u044e\u0449\u0435\u0439 \u043f\u043e\u043f\u044b\u0442\u043a\u0438')),
+                ('claim', models.CharField(default=b'', max_length=32, editable=False, blank=True)),
+                ('last_error', models.TextField(default=b'', verbose_name='\u041f\u043e\u0441\u043b\u0435\u0434\u043d\u044f\u044f \u043e\u0448\u0438\u0431\u043a\u0430', blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(null=True, verbose_name='\u0412\u0440\u0435\u043c\u044f \u043e\u0442\u043f\u0440\u0430\u0432\u043a\u0438', blank=True)),
+                ('module', models.ForeignKey(related_name='+', verbose_name='\u041e\u0431\u0440\u0430\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c\u043d\u044b\u0439 \u043c\u043e\u0434\u0443\u043b\u044c', to='plp_edmodule.EducationalModule')),
+                ('user', models.ForeignKey(related_name='+', verbose_name='\u041f\u043e\u043b\u044c\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': '\u041f\u0438\u0441\u044c\u043c\u043e \u043c\u043e\u0434\u0443\u043b\u044f',
+                'verbose_name_plural': '\u041f\u0438\u0441\u044c\u043c\u0430 \u043c\u043e\u0434\u0443\u043b\u044f',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='educationalmoduleemail',
+            index_together=set([('status', 'next_attempt_at')]),
+        ),
+    ]
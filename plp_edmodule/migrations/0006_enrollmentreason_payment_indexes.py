@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+YAMONEY_ORDER_INDEX = 'plp_edmodule_reason_yamoney_order_uniq'
+
+
+def create_yamoney_unique_index(apps, schema_editor):
+    # номер заказа яндекс-кассы уникален; частичный индекс поддерживается только в postgresql
+    if schema_editor.connection.vendor == 'postgresql':
+        model = apps.get_model('plp_edmodule', 'EducationalModuleEnrollmentReason')
+        duplicates = list(model.objects.filter(payment_type='yamoney', payment_order_id__isnull=False).values(
+            'payment_order_id').annotate(count=models.Count('id')).filter(count__gt=1).values_list(
+            'payment_order_id', flat=True)[:20])
+        if duplicates:
+            # платежные данные не исправляются автоматически: дубли нужно разобрать вручную
+            raise RuntimeError(
+                'Duplicate yamoney payment_order_id in {}: {}. Resolve them (e.g. with reconcile_edmodule_payments) '
+                'and rerun the migration'.format(model._meta.db_table, ', '.join(duplicates)))
+        schema_editor.execute(
+            "CREATE UNIQUE INDEX {} ON {} (payment_order_id) WHERE payment_type = 'yamoney'".format(
+                YAMONEY_ORDER_INDEX, model._meta.db_table)
+        )
+
+
+def drop_yamoney_unique_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS {}'.format(YAMONEY_ORDER_INDEX))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0005_educationalmoduleemail'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='educationalmoduleenrollmentreason',
+            index_together=set([('payment_order_id', 'payment_type')]),
+        ),
+        migrations.RunPython(create_yamoney_unique_index, drop_yamoney_unique_index),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0006_enrollmentreason_payment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleRatingSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='\u041a\u043e\u043b\u0438\u0447\u0435\u0441\u0442\u0432\u043e \u043e\u0446\u0435\u043d\u043e\u043a')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='\u0421\u0443\u043c\u043c\u0430 \u043e\u0446\u0435\u043d\u043e\u043a')),
+                ('rating_1', models.PositiveIntegerField(default=0)),
+                ('rating_2', models.PositiveIntegerField(default=0)),
+                ('rating_3', models.PositiveIntegerField(default=0)),
+                ('rating_4', models.PositiveIntegerField(default=0)),
+                ('rating_5', models.PositiveIntegerField(default=0)),
+                ('module', models.OneToOneField(related_name='rating_summary', verbose_name='\u041e\u0431\u0440\u0430\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c\u043d\u044b\u0439 \u043c\u043e\u0434\u0443\u043b\u044c', to='plp_edmodule.EducationalModule')),
+            ],
+            options={
+                'verbose_name': '\u0421\u0432\u043e\u0434\u043d\u044b\u0439 \u0440\u0435\u0439\u0442\u0438\u043d\u0433 \u043c\u043e\u0434\u0443\u043b\u044f',
+                'verbose_name_plural': '\u0421\u0432\u043e\u0434\u043d\u044b\u0435 \u0440\u0435\u0439\u0442\u0438\u043d\u0433\u0438 \u043c\u043e\u0434\u0443\u043b\u0435\u0439',
+            },
+        ),
+    ]
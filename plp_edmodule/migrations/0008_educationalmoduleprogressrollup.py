@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0007_educationalmoduleratingsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EducationalModuleProgressRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('course_id', models.CharField(max_length=255, verbose_name='Id \u0441\u0435\u0441\u0441\u0438\u0438 \u043a\u0443\u0440\u0441\u0430 \u0432 edx')),
+                ('day', models.DateField(verbose_name='\u0414\u0430\u0442\u0430')),
+                ('started', models.PositiveIntegerField(default=0, verbose_name='\u041f\u0440\u0438\u0441\u0442\u0443\u043f\u0438\u043b\u0438')),
+                ('passing', models.PositiveIntegerField(default=0, verbose_name='\u041a\u0443\u0440\u0441 \u0437\u0430\u0441\u0447\u0438\u0442\u0430\u043d')),
+                ('finished', models.PositiveIntegerField(default=0, verbose_name='\u0417\u0430\u0432\u0435\u0440\u0448\u0438\u043b\u0438')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('module', models.ForeignKey(related_name='+', verbose_name='\u041e\u0431\u0440\u0430\u0437\u043e\u0432\u0430\u0442\u0435\u043b\u044c\u043d\u044b\u0439 \u043c\u043e\u0434\u0443\u043b\u044c', to='plp_edmodule.EducationalModule')),
+                ('session', models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, verbose_name='\u0421\u0435\u0441\u0441\u0438\u044f \u043a\u0443\u0440\u0441\u0430', blank=True, to='plp.CourseSession', null=True)),
+            ],
+            options={
+                'verbose_name': '\u0421\u0440\u0435\u0437 \u043f\u0440\u043e\u0433\u0440\u0435\u0441\u0441\u0430 \u043f\u043e \u043c\u043e\u0434\u0443\u043b\u044e',
+                'verbose_name_plural': '\u0421\u0440\u0435\u0437\u044b \u043f\u0440\u043e\u0433\u0440\u0435\u0441\u0441\u0430 \u043f\u043e \u043c\u043e\u0434\u0443\u043b\u044f\u043c',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='educationalmoduleprogressrollup',
+            unique_together=set([('module', 'course_id', 'day')]),
+        ),
+    ]
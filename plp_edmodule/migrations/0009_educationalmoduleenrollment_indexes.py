@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('plp_edmodule', '0008_educationalmoduleprogressrollup'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='educationalmoduleenrollment',
+            index_together=set([('module', 'is_active', 'is_paid', 'is_graduated'),
+                                ('is_active', 'is_paid', 'is_graduated')]),
+        ),
+    ]
@@ -1,13 +1,67 @@
 # coding: utf-8
 
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core import validators
-from django.db import models
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from jsonfield import JSONField
-from plp.models import Course, Instructor, User
+from plp.models import Course, CourseSession, HonorCode, Instructor, User
 from plp_extension.apps.course_review.models import AbstractRating
 from .signals import edmodule_enrolled, edmodule_enrolled_handler, edmodule_payed, edmodule_payed_handler, \
-    edmodule_unenrolled, edmodule_unenrolled_handler
+    edmodule_unenrolled, edmodule_unenrolled_handler, course_changed_handler, course_pre_delete_handler, \
+    course_deleted_handler, course_session_pre_save_handler, course_session_changed_handler, \
+    course_relations_changed_handler, catalog_changed_handler, rating_pre_save_handler, rating_saved_handler, \
+    rating_deleted_handler, honor_code_changed_handler
+
+
+STARTED_SESSIONS_TTL = getattr(settings, 'EDMODULE_STARTED_SESSIONS_TTL', 10 * 60)
+
+
+class EducationalModuleManager(models.Manager):
+    def started_sessions(self, module_ids):
+        """
+        начавшиеся и еще не закончившиеся сессии курсов модулей; отбор по датам выполняется в sql
+        """
+        now = timezone.now()
+        return CourseSession.objects.filter(
+            course__education_modules__in=module_ids,
+            datetime_starts__lte=now,
+        ).filter(
+            models.Q(datetime_ends__isnull=True) | models.Q(datetime_ends__gt=now)
+        ).select_related('course__university').distinct()
+
+    def started_course_ids(self, module_ids):
+        """
+        начавшиеся сессии курсов модулей: {id модуля: {id сессии в edx: id сессии}}.
+        Результат кэшируется по модулям на STARTED_SESSIONS_TTL секунд, недостающие модули
+        вычисляются вместе двумя запросами
+        """
+        keys = dict((self._started_key(i), i) for i in module_ids)
+        result = dict((keys[k], v) for k, v in cache.get_many(keys.keys()).iteritems())
+        missing = [i for i in module_ids if i not in result]
+        if missing:
+            modules_by_course = {}
+            for module_id, course_id in self.model.courses.through.objects.filter(
+                    educationalmodule__in=missing).values_list('educationalmodule_id', 'course_id'):
+                modules_by_course.setdefault(course_id, []).append(module_id)
+            computed = dict((i, {}) for i in missing)
+            for session in self.started_sessions(missing):
+                for module_id in modules_by_course.get(session.course_id, []):
+                    computed[module_id][session.get_absolute_slug_v1()] = session.id
+            cache.set_many(dict((self._started_key(k), v) for k, v in computed.iteritems()), STARTED_SESSIONS_TTL)
+            result.update(computed)
+        return result
+
+    def invalidate_started_course_ids(self, module_ids):
+        cache.delete_many([self._started_key(i) for i in module_ids])
+
+    @staticmethod
+    def _started_key(module_id):
+        return 'edmodule_started_sessions:{}'.format(module_id)
 
 
 class EducationalModule(models.Model):
@@ -21,34 +75,80 @@ class EducationalModule(models.Model):
         validators.MinValueValidator(0),
         validators.MaxValueValidator(100)
     ])
+    courses_count = models.PositiveIntegerField(verbose_name=_(u'Количество курсов'), default=0, editable=False)
+    duration_weeks = models.PositiveIntegerField(verbose_name=_(u'Длительность (в неделях)'), null=True,
+                                                 editable=False)
+    courses_slugs = models.TextField(verbose_name=_(u'Коды курсов'), blank=True, default='', editable=False)
+    instructors_cache = models.ManyToManyField(Instructor, verbose_name=_(u'Преподаватели'), related_name='+',
+                                               blank=True, editable=False)
+
+    objects = EducationalModuleManager()
 
     class Meta:
         verbose_name = _(u'Образовательный модуль')
         verbose_name_plural = _(u'Образовательные модули')
 
     def __unicode__(self):
-        return ', '.join(self.courses.values_list('slug', flat=True)) or self.about[:20]
+        return self.courses_slugs or self.about[:20]
 
     @property
     def duration(self):
         """
         сумма длительностей курсов (в неделях)
         """
-        try:
-            return sum([i.course_weeks() for i in self.courses.all()])
-        except TypeError:
-            return None
+        return self.duration_weeks
 
     @property
     def instructors(self):
         """
         объединение множества преподавателей всех курсов модуля
         """
-        return Instructor.objects.filter(instructor_courses=self.courses.all()).distinct()
+        return self.instructors_cache.all()
+
+    def update_aggregates(self):
+        """
+        пересчет хранимых агрегатов модуля: количества и длительности курсов, их кодов и преподавателей.
+        Выполняется в одной транзакции, так что список преподавателей не бывает виден пустым
+        """
+        courses = list(self.courses.all())
+        try:
+            duration = sum([i.course_weeks() for i in courses])
+        except TypeError:
+            duration = None
+        self.courses_count = len(courses)
+        self.duration_weeks = duration
+        self.courses_slugs = ', '.join(c.slug for c in courses)
+        with transaction.atomic():
+            EducationalModule.objects.filter(pk=self.pk).update(
+                courses_count=self.courses_count,
+                duration_weeks=self.duration_weeks,
+                courses_slugs=self.courses_slugs,
+            )
+            self.instructors_cache.clear()
+            self.instructors_cache.add(*Instructor.objects.filter(instructor_courses__in=courses).distinct())
 
     # TODO: категории
     
     
+class EducationalModuleEnrollmentManager(models.Manager):
+    def set_active(self, user, module, is_active):
+        """
+        запись на модуль (is_active=True) или отписка от него за один условный UPDATE,
+        а для новой записи - за один INSERT. Возвращает (запись, changed); changed истинно
+        только для вызова, который действительно изменил состояние, запись в остальных случаях - None
+        """
+        qs = self.filter(user=user, module=module)
+        if qs.filter(is_active=not is_active).update(is_active=is_active, updated_at=timezone.now()):
+            return qs.select_related('user', 'module').get(), True
+        if not is_active:
+            return None, False
+        try:
+            with transaction.atomic():
+                return self.create(user=user, module=module, is_active=True), True
+        except IntegrityError:
+            return None, False
+
+
 class EducationalModuleEnrollment(models.Model):
     user = models.ForeignKey(User, verbose_name=_(u'Пользователь'))
     module = models.ForeignKey(EducationalModule, verbose_name=_(u'Образовательный модуль'))
@@ -58,22 +158,75 @@ class EducationalModuleEnrollment(models.Model):
     _ctime = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = EducationalModuleEnrollmentManager()
+
     class Meta:
         verbose_name = _(u'Запись на модуль')
         verbose_name_plural = _(u'Записи на модуль')
         unique_together = ('user', 'module')
+        index_together = [
+            ('module', 'is_active', 'is_paid', 'is_graduated'),
+            ('is_active', 'is_paid', 'is_graduated'),
+        ]
 
 
 class EducationalModuleProgress(models.Model):
     enrollment = models.OneToOneField(EducationalModuleEnrollment, verbose_name=_(u'Запись на модуль'),
                                       related_name='progress')
-    progress = JSONField(verbose_name=_(u'Прогресс'), null=True)
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_(u'Время последнего обращения к edx'))
 
     class Meta:
         verbose_name = _(u'Прогресс по модулю')
         verbose_name_plural = _(u'Прогресс по модулям')
 
+    @property
+    def progress(self):
+        """
+        прогресс в прежнем формате {id сессии в edx: данные из edx}, собранный из прогресса по курсам
+        """
+        return dict(EducationalModuleCourseProgress.objects.filter(
+            enrollment_id=self.enrollment_id).values_list('course_id', 'data')) or None
+
+
+class EducationalModuleCourseProgress(models.Model):
+    enrollment = models.ForeignKey(EducationalModuleEnrollment, verbose_name=_(u'Запись на модуль'),
+                                   related_name='course_progress')
+    course_id = models.CharField(verbose_name=_(u'Id сессии курса в edx'), max_length=255)
+    session = models.ForeignKey(CourseSession, verbose_name=_(u'Сессия курса'), null=True, blank=True,
+                                on_delete=models.SET_NULL, related_name='+')
+    passed = models.BooleanField(verbose_name=_(u'Курс пройден'), default=False)
+    grade = models.FloatField(verbose_name=_(u'Оценка'), null=True, blank=True)
+    data = JSONField(verbose_name=_(u'Прогресс'), null=True)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_(u'Время последнего обращения к edx'))
+
+    class Meta:
+        verbose_name = _(u'Прогресс по курсу модуля')
+        verbose_name_plural = _(u'Прогресс по курсам модуля')
+        unique_together = ('enrollment', 'course_id')
+        index_together = [('course_id', 'passed')]
+
+
+class EducationalModuleProgressRollup(models.Model):
+    """
+    дневной срез прогресса активных слушателей модуля по сессии курса:
+    started - есть прогресс по курсу, passing - курс засчитан,
+    finished - курс засчитан и сессия уже закончилась
+    """
+    module = models.ForeignKey(EducationalModule, verbose_name=_(u'Образовательный модуль'), related_name='+')
+    course_id = models.CharField(verbose_name=_(u'Id сессии курса в edx'), max_length=255)
+    session = models.ForeignKey(CourseSession, verbose_name=_(u'Сессия курса'), null=True, blank=True,
+                                on_delete=models.SET_NULL, related_name='+')
+    day = models.DateField(verbose_name=_(u'Дата'))
+    started = models.PositiveIntegerField(verbose_name=_(u'Приступили'), default=0)
+    passing = models.PositiveIntegerField(verbose_name=_(u'Курс засчитан'), default=0)
+    finished = models.PositiveIntegerField(verbose_name=_(u'Завершили'), default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _(u'Срез прогресса по модулю')
+        verbose_name_plural = _(u'Срезы прогресса по модулям')
+        unique_together = ('module', 'course_id', 'day')
+
 
 class EducationalModuleUnsubscribe(models.Model):
     user = models.ForeignKey(User, verbose_name=_(u'Пользователь'))
@@ -85,11 +238,153 @@ class EducationalModuleUnsubscribe(models.Model):
         unique_together = ('user', 'module')
 
 
+class EducationalModuleNotification(models.Model):
+    """
+    журнал отправленных массовых рассылок: повторный запуск рассылки пропускает
+    пользователей, которым письмо по сессии уже отправлено
+    """
+    class KIND:
+        COURSE_STARTS = 'course_starts'
+        COURSE_ENROLL_ENDS = 'course_enroll_ends'
+        CHOICES = [(v, v) for v in (COURSE_STARTS, COURSE_ENROLL_ENDS)]
+
+    session = models.ForeignKey(CourseSession, verbose_name=_(u'Сессия курса'), related_name='+')
+    user = models.ForeignKey(User, verbose_name=_(u'Пользователь'), related_name='+')
+    kind = models.CharField(verbose_name=_(u'Тип рассылки'), max_length=32, choices=KIND.CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _(u'Отправленное уведомление модуля')
+        verbose_name_plural = _(u'Отправленные уведомления модуля')
+        unique_together = ('session', 'user', 'kind')
+
+
+class EducationalModuleEmail(models.Model):
+    """
+    очередь транзакционных писем модуля: пишется в транзакции вызывающего кода,
+    отправляется фоновой задачей
+    """
+    class KIND:
+        ENROLLED = 'enrolled'
+        UNENROLLED = 'unenrolled'
+        PAYED = 'payed'
+        CHOICES = [(v, v) for v in (ENROLLED, UNENROLLED, PAYED)]
+
+    class STATUS:
+        PENDING = 'pending'
+        SENT = 'sent'
+        FAILED = 'failed'
+        CHOICES = [(v, v) for v in (PENDING, SENT, FAILED)]
+
+    kind = models.CharField(verbose_name=_(u'Тип письма'), max_length=16, choices=KIND.CHOICES)
+    user = models.ForeignKey(User, verbose_name=_(u'Пользователь'), related_name='+')
+    module = models.ForeignKey(EducationalModule, verbose_name=_(u'Образовательный модуль'), related_name='+')
+    status = models.CharField(verbose_name=_(u'Статус'), max_length=16, choices=STATUS.CHOICES,
+                              default=STATUS.PENDING)
+    attempts = models.PositiveSmallIntegerField(verbose_name=_(u'Попыток отправки'), default=0)
+    next_attempt_at = models.DateTimeField(verbose_name=_(u'Время следующей попытки'), default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True, default='', editable=False)
+    last_error = models.TextField(verbose_name=_(u'Последняя ошибка'), blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(verbose_name=_(u'Время отправки'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _(u'Письмо модуля')
+        verbose_name_plural = _(u'Письма модуля')
+        index_together = [('status', 'next_attempt_at')]
+
+
 class EducationalModuleRating(AbstractRating):
     class Meta:
         verbose_name = _(u'Отзыв о модуле')
         verbose_name_plural = _(u'Отзывы о модуле')
 
+    def summary_contribution(self):
+        """
+        (id модуля, оценка), если отзыв учитывается в сводном рейтинге модуля, иначе None
+        """
+        if self.content_type_id != ContentType.objects.get_for_model(EducationalModule).id:
+            return None
+        if self.status != 'published' or self.declined:
+            return None
+        return self.object_id, self.rating
+
+
+class EducationalModuleRatingSummaryManager(models.Manager):
+    def apply(self, module_id, rating, sign=1):
+        """
+        учет (sign=1) или исключение (sign=-1) одной оценки в сводном рейтинге модуля
+        """
+        updates = {'count': models.F('count') + sign, 'total': models.F('total') + sign * rating}
+        if 1 <= rating <= 5:
+            field = 'rating_{}'.format(rating)
+            updates[field] = models.F(field) + sign
+        if not self.filter(module_id=module_id).update(**updates):
+            try:
+                with transaction.atomic():
+                    self.create(module_id=module_id)
+            except IntegrityError:
+                pass
+            self.filter(module_id=module_id).update(**updates)
+
+    def compute(self, module_ids=None):
+        """
+        сводный рейтинг, посчитанный заново по отзывам: {id модуля: {поле: значение}}
+        """
+        ratings = EducationalModuleRating.objects.filter(
+            content_type=ContentType.objects.get_for_model(EducationalModule), status='published', declined=False)
+        if module_ids is not None:
+            ratings = ratings.filter(object_id__in=module_ids)
+        result = {}
+        for module_id, rating, count in ratings.values_list('object_id', 'rating').annotate(
+                n=models.Count('id')).order_by():
+            summary = result.setdefault(module_id, dict(
+                [('count', 0), ('total', 0)] + [('rating_{}'.format(i), 0) for i in range(1, 6)]))
+            summary['count'] += count
+            summary['total'] += count * rating
+            if 1 <= rating <= 5:
+                summary['rating_{}'.format(rating)] += count
+        return result
+
+    def rebuild(self, module_ids=None):
+        """
+        пересчет сводных рейтингов модулей по всем отзывам
+        """
+        modules = EducationalModule.objects.all()
+        if module_ids is not None:
+            modules = modules.filter(id__in=module_ids)
+        computed = self.compute(module_ids)
+        empty = dict([('count', 0), ('total', 0)] + [('rating_{}'.format(i), 0) for i in range(1, 6)])
+        with transaction.atomic():
+            for module_id in modules.values_list('id', flat=True):
+                self.update_or_create(module_id=module_id, defaults=computed.get(module_id, empty))
+
+
+class EducationalModuleRatingSummary(models.Model):
+    module = models.OneToOneField(EducationalModule, verbose_name=_(u'Образовательный модуль'),
+                                  related_name='rating_summary')
+    count = models.PositiveIntegerField(verbose_name=_(u'Количество оценок'), default=0)
+    total = models.PositiveIntegerField(verbose_name=_(u'Сумма оценок'), default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+
+    objects = EducationalModuleRatingSummaryManager()
+
+    class Meta:
+        verbose_name = _(u'Сводный рейтинг модуля')
+        verbose_name_plural = _(u'Сводные рейтинги модулей')
+
+    @property
+    def average(self):
+        return round(float(self.total) / self.count, 2) if self.count else None
+
+    @property
+    def histogram(self):
+        return dict((i, getattr(self, 'rating_{}'.format(i))) for i in range(1, 6))
+
 
 class EducationalModuleEnrollmentType(models.Model):
     EDX_MODES = (
@@ -137,8 +432,26 @@ class EducationalModuleEnrollmentReason(models.Model):
     class Meta:
         verbose_name = _(u'Причина записи')
         verbose_name_plural = _(u'Причины записи')
+        index_together = [('payment_order_id', 'payment_type')]
 
 
 edmodule_enrolled.connect(edmodule_enrolled_handler, sender=EducationalModuleEnrollment)
 edmodule_unenrolled.connect(edmodule_unenrolled_handler, sender=EducationalModuleEnrollment)
 edmodule_payed.connect(edmodule_payed_handler, sender=EducationalModuleEnrollmentReason)
+
+post_save.connect(course_changed_handler, sender=Course)
+pre_delete.connect(course_pre_delete_handler, sender=Course)
+post_delete.connect(course_deleted_handler, sender=Course)
+pre_save.connect(course_session_pre_save_handler, sender=CourseSession)
+post_save.connect(course_session_changed_handler, sender=CourseSession)
+post_delete.connect(course_session_changed_handler, sender=CourseSession)
+m2m_changed.connect(course_relations_changed_handler)
+post_save.connect(catalog_changed_handler, sender=EducationalModule)
+post_delete.connect(catalog_changed_handler, sender=EducationalModule)
+post_save.connect(catalog_changed_handler, sender=EducationalModuleEnrollmentType)
+post_delete.connect(catalog_changed_handler, sender=EducationalModuleEnrollmentType)
+pre_save.connect(rating_pre_save_handler, sender=EducationalModuleRating)
+post_save.connect(rating_saved_handler, sender=EducationalModuleRating)
+post_delete.connect(rating_deleted_handler, sender=EducationalModuleRating)
+post_save.connect(honor_code_changed_handler, sender=HonorCode)
+post_delete.connect(honor_code_changed_handler, sender=HonorCode)
@@ -1,39 +1,172 @@
 # coding: utf-8
 
+import logging
+import time
+import uuid
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import IntegrityError, connection, transaction
+from django.template.loader import get_template
+from django.utils import timezone
+from emails.django import Message
+from plp.models import Participant
 from plp.notifications.base import MassSendEmails
-from .models import EducationalModule, EducationalModuleEnrollment
+from plp.utils.helpers import get_domain_url
+from .metrics import get_metrics
+from .models import EducationalModuleEmail, EducationalModuleEnrollment, EducationalModuleNotification, \
+    EducationalModuleUnsubscribe
+
+MAIL_CHUNK_SIZE = getattr(settings, 'EDMODULE_MAIL_CHUNK_SIZE', 500)
+OUTBOX_BATCH_SIZE = getattr(settings, 'EDMODULE_OUTBOX_BATCH_SIZE', 100)
+OUTBOX_MAX_ATTEMPTS = getattr(settings, 'EDMODULE_OUTBOX_MAX_ATTEMPTS', 6)
+OUTBOX_RETRY_DELAY = getattr(settings, 'EDMODULE_OUTBOX_RETRY_DELAY', 60)
+OUTBOX_CLAIM_TIMEOUT = getattr(settings, 'EDMODULE_OUTBOX_CLAIM_TIMEOUT', 600)
+
+OUTBOX_TEMPLATES = {
+    EducationalModuleEmail.KIND.ENROLLED: ('emails/edmodule_enrolled_subject.txt',
+                                           'emails/edmodule_enrolled_html.html'),
+    EducationalModuleEmail.KIND.UNENROLLED: ('emails/edmodule_unenrolled_subject.txt',
+                                             'emails/edmodule_unenrolled_html.html'),
+    EducationalModuleEmail.KIND.PAYED: ('emails/edmodule_payed_subject.txt',
+                                        'emails/edmodule_payed_html.html'),
+}
+
+_templates = {}
+
+
+def get_email_template(name):
+    """
+    скомпилированный шаблон письма; компилируется один раз на процесс
+    """
+    if name not in _templates:
+        _templates[name] = get_template(name)
+    return _templates[name]
 
 
 class EdmoduleCourseStartsEmails(MassSendEmails):
     """
     Класс для массовой рассылки сообщений о начале курса, на который пользователь не записан,
     из образовательного модуля, на который он записан.
+    Получатели выбираются одним запросом и обрабатываются порциями по chunk_size,
+    поэтому расход памяти не зависит от размера аудитории. Отправленные письма отмечаются
+    в EducationalModuleNotification, и повторный запуск их пропускает.
     """
     template_html = 'emails/edmodule_course_not_enrolled_starts_html.html'
     template_subject = 'emails/edmodule_course_not_enrolled_starts_subject.txt'
+    notification_kind = EducationalModuleNotification.KIND.COURSE_STARTS
+    chunk_size = MAIL_CHUNK_SIZE
 
     def __init__(self, session):
         self.session = session
         super(EdmoduleCourseStartsEmails, self).__init__()
-        self.email_to_username = {}
+
+    def get_enrollments(self):
+        """
+        активные записи на модули, в которые входит курс сессии, за исключением отписавшихся
+        от рассылок модуля, уже записанных на сессию пользователей и уже получивших это письмо
+        """
+        qn = connection.ops.quote_name
+        enrollment = qn(EducationalModuleEnrollment._meta.db_table)
+        notification = qn(EducationalModuleNotification._meta.db_table)
+        return EducationalModuleEnrollment.objects.filter(
+            is_active=True,
+            module__courses=self.session.course_id,
+        ).exclude(user__email='').extra(
+            where=[
+                'NOT EXISTS (SELECT 1 FROM {unsubscribe} WHERE {unsubscribe}.user_id = {enrollment}.user_id '
+                'AND {unsubscribe}.module_id = {enrollment}.module_id)'.format(
+                    unsubscribe=qn(EducationalModuleUnsubscribe._meta.db_table), enrollment=enrollment),
+                'NOT EXISTS (SELECT 1 FROM {participant} WHERE {participant}.user_id = {enrollment}.user_id '
+                'AND {participant}.session_id = %s)'.format(
+                    participant=qn(Participant._meta.db_table), enrollment=enrollment),
+                'NOT EXISTS (SELECT 1 FROM {notification} WHERE {notification}.user_id = {enrollment}.user_id '
+                'AND {notification}.session_id = %s AND {notification}.kind = %s)'.format(
+                    notification=notification, enrollment=enrollment),
+            ],
+            params=[self.session.id, self.session.id, self.notification_kind],
+        ).select_related('user', 'module').order_by('user_id', 'module_id')
+
+    def iter_chunks(self):
+        """
+        порции записей, по одной записи на пользователя; выборка идет по ключу user_id,
+        так что в памяти одновременно находится не больше chunk_size записей
+        """
+        qs = self.get_enrollments()
+        last_user_id = 0
+        while True:
+            chunk = list(qs.filter(user_id__gt=last_user_id)[:self.chunk_size])
+            if not chunk:
+                break
+            last_user_id = chunk[-1].user_id
+            seen = set()
+            yield [i for i in chunk if not (i.user_id in seen or seen.add(i.user_id))]
 
     def get_emails(self):
-        enrollments = EducationalModuleEnrollment.objects.filter(
-            module__in=EducationalModule.objects.filter(courses=self.session.course)
-        )
-        self.enrollment_by_email = dict([
-            (i.user.email, i) for i in enrollments
-        ])
-        return list(set(self.enrollment_by_email.keys()))
-
-    def get_context(self, email=None):
+        for chunk in self.iter_chunks():
+            for enrollment in chunk:
+                yield enrollment.user.email
+
+    def get_context(self, enrollment):
         return {
-            'module': self.enrollment_by_email[email].module,
-            'user': self.enrollment_by_email[email].user,
+            'module': enrollment.module,
+            'user': enrollment.user,
             'course': self.session.course,
             'site': self.get_site()
         }
 
+    def mark_sent(self, user_ids):
+        """
+        запись отправленных писем в журнал рассылок
+        """
+        rows = [EducationalModuleNotification(session_id=self.session.id, user_id=i, kind=self.notification_kind)
+                for i in user_ids]
+        try:
+            with transaction.atomic():
+                EducationalModuleNotification.objects.bulk_create(rows)
+        except IntegrityError:
+            for row in rows:
+                EducationalModuleNotification.objects.get_or_create(
+                    session_id=row.session_id, user_id=row.user_id, kind=row.kind)
+
+    def send(self):
+        """
+        отправка писем порциями; на каждую порцию открывается одно smtp-соединение.
+        Каждое доставленное письмо сразу записывается в журнал рассылок, так что при повторе
+        после прерванной отправки уже доставленные письма не отправляются снова
+        """
+        subject = get_email_template(self.template_subject)
+        html = get_email_template(self.template_html)
+        metrics = get_metrics()
+        sent, failed = 0, 0
+        for chunk in self.iter_chunks():
+            smtp = get_connection()
+            smtp.open()
+            try:
+                for enrollment in chunk:
+                    user = enrollment.user
+                    msg = Message(
+                        subject=subject,
+                        html=html,
+                        mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
+                        mail_to=(user.get_full_name(), user.email)
+                    )
+                    started = time.time()
+                    try:
+                        msg.send(context={'context': self.get_context(enrollment)}, connection=smtp)
+                    except Exception:
+                        failed += 1
+                        metrics.incr('email.failed', kind=self.notification_kind)
+                        logging.exception('Failed to send {} to {}'.format(self.__class__.__name__, user.email))
+                    else:
+                        self.mark_sent([user.id])
+                        sent += 1
+                    metrics.timing('email.send_ms', (time.time() - started) * 1000, kind=self.notification_kind)
+            finally:
+                smtp.close()
+        logging.info('{} for session {}: {} sent, {} failed'.format(
+            self.__class__.__name__, self.session.id, sent, failed))
+        return sent
+
 
 class EdmoduleCourseEnrollEndsEmails(EdmoduleCourseStartsEmails):
     """
@@ -42,3 +175,91 @@ class EdmoduleCourseEnrollEndsEmails(EdmoduleCourseStartsEmails):
     """
     template_html = 'emails/edmodule_course_enroll_ends_html.html'
     template_subject = 'emails/edmodule_course_enroll_ends_subject.txt'
+    notification_kind = EducationalModuleNotification.KIND.COURSE_ENROLL_ENDS
+
+
+def _claim_outbox_emails(batch_size):
+    """
+    захват порции писем, готовых к отправке. Письма помечаются токеном и откладываются на
+    OUTBOX_CLAIM_TIMEOUT, поэтому параллельные обработчики не возьмут их повторно
+    """
+    now = timezone.now()
+    ready = EducationalModuleEmail.objects.filter(status=EducationalModuleEmail.STATUS.PENDING,
+                                                  next_attempt_at__lte=now)
+    ids = list(ready.order_by('next_attempt_at').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+    claim = uuid.uuid4().hex
+    ready.filter(id__in=ids).update(
+        claim=claim, next_attempt_at=now + timezone.timedelta(seconds=OUTBOX_CLAIM_TIMEOUT))
+    return list(EducationalModuleEmail.objects.filter(claim=claim).select_related('user', 'module'))
+
+
+def send_outbox_emails(batch_size=OUTBOX_BATCH_SIZE, max_batches=None):
+    """
+    отправка писем из очереди порциями по одному smtp-соединению на порцию.
+    Неудачные попытки повторяются с экспоненциально растущей задержкой,
+    после OUTBOX_MAX_ATTEMPTS попыток письмо помечается как неотправленное
+    """
+    metrics = get_metrics()
+    sent, failed, batches = 0, 0, 0
+    site = get_domain_url()
+    while max_batches is None or batches < max_batches:
+        emails = _claim_outbox_emails(batch_size)
+        if not emails:
+            break
+        batches += 1
+        delivered = []
+        smtp = get_connection()
+        try:
+            smtp.open()
+        except Exception as exc:
+            for email in emails:
+                _schedule_outbox_retry(email, exc)
+            failed += len(emails)
+            continue
+        try:
+            for email in emails:
+                user = email.user
+                started = time.time()
+                try:
+                    subject, html = OUTBOX_TEMPLATES[email.kind]
+                    msg = Message(
+                        subject=get_email_template(subject),
+                        html=get_email_template(html),
+                        mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
+                        mail_to=(user.get_full_name(), user.email)
+                    )
+                    context = {'module': email.module, 'user': user, 'site': site}
+                    msg.send(context={'context': context}, connection=smtp)
+                    delivered.append(email.id)
+                except Exception as exc:
+                    failed += 1
+                    metrics.incr('email.failed', kind=email.kind)
+                    _schedule_outbox_retry(email, exc)
+                metrics.timing('email.send_ms', (time.time() - started) * 1000, kind=email.kind)
+        finally:
+            smtp.close()
+            EducationalModuleEmail.objects.filter(id__in=delivered).update(
+                status=EducationalModuleEmail.STATUS.SENT, sent_at=timezone.now(), claim='')
+            sent += len(delivered)
+    if batches:
+        logging.info('Module email outbox: {} sent, {} failed in {} batches'.format(sent, failed, batches))
+    return sent
+
+
+def _schedule_outbox_retry(email, exc):
+    attempts = email.attempts + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        status = EducationalModuleEmail.STATUS.FAILED
+        logging.error('Module email {} to {} failed after {} attempts: {}'.format(
+            email.id, email.user.email, attempts, exc))
+    else:
+        status = EducationalModuleEmail.STATUS.PENDING
+    EducationalModuleEmail.objects.filter(id=email.id).update(
+        status=status,
+        attempts=attempts,
+        claim='',
+        last_error=str(exc)[:1000],
+        next_attempt_at=timezone.now() + timezone.timedelta(seconds=OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)),
+    )
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+агрегированная отправка ошибок в sentry: одинаковые ошибки (по отпечатку) группируются,
+за окно EDMODULE_ERROR_REPORT_WINDOW секунд отправляется одно событие с их числом и примерами.
+Отправка идет из фонового потока; очередь ограничена, при переполнении события отбрасываются,
+так что вызывающий поток никогда не блокируется
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from django.utils import six
+from django.utils.six.moves import queue
+from raven import Client
+
+RAVEN_CONFIG = getattr(settings, 'RAVEN_CONFIG', {})
+REPORT_WINDOW = getattr(settings, 'EDMODULE_ERROR_REPORT_WINDOW', 60)
+REPORT_QUEUE_SIZE = getattr(settings, 'EDMODULE_ERROR_REPORT_QUEUE_SIZE', 1000)
+REPORT_SAMPLES = getattr(settings, 'EDMODULE_ERROR_REPORT_SAMPLES', 3)
+SAMPLE_VALUE_LIMIT = 200
+
+client = None
+
+if RAVEN_CONFIG:
+    client = Client(RAVEN_CONFIG.get('dsn'))
+
+
+def _truncate(value):
+    if isinstance(value, dict):
+        return dict((k, _truncate(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_truncate(i) for i in value]
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    value = value if isinstance(value, six.string_types) else repr(value)
+    return value[:SAMPLE_VALUE_LIMIT]
+
+
+class ErrorReporter(object):
+    """
+    накопление ошибок по отпечаткам и отправка сводки раз в окно
+    """
+    def __init__(self, client=None, window=REPORT_WINDOW, queue_size=REPORT_QUEUE_SIZE, samples=REPORT_SAMPLES):
+        self.client = client
+        self.window = window
+        self.queue_size = queue_size
+        self.samples = samples
+        self.dropped = 0
+        self._lock = threading.RLock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._groups = {}
+
+    def report(self, message, fingerprint=None, level='error', **extra):
+        """
+        регистрация ошибки; не блокирует и не обращается к сети
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fingerprint or message, message, level, extra, time.time()))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # после fork поток родителя в процессе не существует
+            self._queue = queue.Queue(self.queue_size)
+            self._groups = {}
+            self._thread = threading.Thread(target=self._run, name='edmodule-error-reporter')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _add(self, item):
+        fingerprint, message, level, extra, created = item
+        group = self._groups.get(fingerprint)
+        if group is None:
+            group = self._groups[fingerprint] = {'message': message, 'level': level, 'count': 0,
+                                                 'first_seen': created, 'samples': []}
+        group['count'] += 1
+        group['last_seen'] = created
+        if len(group['samples']) < self.samples:
+            group['samples'].append(_truncate(extra))
+
+    def _run(self):
+        events = self._queue
+        deadline = time.time() + self.window
+        while True:
+            try:
+                item = events.get(timeout=max(deadline - time.time(), 0.01))
+                with self._lock:
+                    self._add(item)
+            except queue.Empty:
+                pass
+            if time.time() >= deadline:
+                try:
+                    self.flush()
+                except Exception:
+                    # поток отправки не должен завершаться из-за ошибки в одной сводке
+                    logging.exception('Error reporter flush failed')
+                deadline = time.time() + self.window
+
+    def flush(self):
+        """
+        отправка сводки по накопленным ошибкам
+        """
+        with self._lock:
+            groups, self._groups = self._groups, {}
+            dropped, self.dropped = self.dropped, 0
+        for fingerprint, group in groups.items():
+            logging.log(logging.getLevelName(group['level'].upper()), '{} ({} times in {:.0f}s){}'.format(
+                group['message'], group['count'], group['last_seen'] - group['first_seen'],
+                ': {}'.format(group['samples'][0]) if group['samples'] else ''))
+            if self.client is None:
+                continue
+            try:
+                self.client.captureMessage(
+                    group['message'],
+                    level=group['level'],
+                    fingerprint=[fingerprint],
+                    extra={
+                        'count': group['count'],
+                        'window': self.window,
+                        'samples': group['samples'],
+                        'dropped': dropped,
+                    },
+                )
+            except Exception:
+                logging.exception('Failed to send error report "{}"'.format(group['message']))
+        if dropped:
+            logging.warning('Error reporter queue is full, {} events dropped'.format(dropped))
+
+    def close(self):
+        """
+        отправка того, что уже в очереди (при завершении процесса)
+        """
+        if self._pid != os.getpid():
+            return
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._add(item)
+        self.flush()
+
+
+reporter = ErrorReporter(client)
+atexit.register(reporter.close)
@@ -1,66 +1,229 @@
 # coding: utf-8
 
-from django.conf import settings
 from django.dispatch import Signal
-from django.template.loader import get_template
-from emails.django import Message
-from plp.utils.helpers import get_domain_url
+from plp.models import Course, Instructor
+from .metrics import get_metrics, timed
 
 edmodule_enrolled = Signal(providing_args=['instance'])
 edmodule_unenrolled = Signal(providing_args=['instance'])
 edmodule_payed = Signal(providing_args=['instance'])
+edmodule_graduated = Signal(providing_args=['instance'])
+
+# поля сессии, от которых зависят агрегаты модулей и кэш начавшихся сессий
+SESSION_AGGREGATE_FIELDS = ('course_id', 'slug', 'datetime_starts', 'datetime_ends')
+
+
+def _queue_email(kind, user_id, module_id):
+    """
+    запись письма в очередь; выполняется в транзакции кода, отправившего сигнал
+    """
+    from .models import EducationalModuleEmail
+    EducationalModuleEmail.objects.create(kind=kind, user_id=user_id, module_id=module_id)
+    get_metrics().incr('email.queued', kind=kind)
 
 
 def edmodule_enrolled_handler(**kwargs):
     """
-    Отправка сообщения об успешной записи на модуль
+    Постановка в очередь сообщения об успешной записи на модуль
     instace - EducationalModuleEnrollment
     """
     instance = kwargs.get('instance')
     if instance:
-        user = instance.user
-        msg = Message(
-            subject=get_template('emails/edmodule_enrolled_subject.txt'),
-            html=get_template('emails/edmodule_enrolled_html.html'),
-            mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
-            mail_to=(user.get_full_name(), user.email)
-        )
-        context = {'module': instance.module, 'user': user, 'site': get_domain_url()}
-        msg.send(context={'context': context})
+        _queue_email('enrolled', instance.user_id, instance.module_id)
 
 
 def edmodule_unenrolled_handler(**kwargs):
     """
-    Отправка сообщения об успешной отписке от модуля
+    Постановка в очередь сообщения об успешной отписке от модуля
     instace - EducationalModuleEnrollment
     """
     instance = kwargs.get('instance')
     if instance:
-        user = instance.user
-        msg = Message(
-            subject=get_template('emails/edmodule_unenrolled_subject.txt'),
-            html=get_template('emails/edmodule_unenrolled_html.html'),
-            mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
-            mail_to=(user.get_full_name(), user.email)
-        )
-        context = {'module': instance.module, 'user': user, 'site': get_domain_url()}
-        msg.send(context={'context': context})
+        _queue_email('unenrolled', instance.user_id, instance.module_id)
 
 
 def edmodule_payed_handler(**kwargs):
     """
-    отправка сообщения об успешной оплате модуля
+    постановка в очередь сообщения об успешной оплате модуля
     instance - EducationalModuleEnrollmentReason
     """
     instance = kwargs.get('instance')
     if instance:
-        module = instance.enrollment.module
-        user = instance.enrollment.user
-        msg = Message(
-            subject=get_template('emails/edmodule_payed_subject.txt'),
-            html=get_template('emails/edmodule_payed_html.html'),
-            mail_from=settings.EMAIL_NOTIFICATIONS_FROM,
-            mail_to=(user.get_full_name(), user.email)
-        )
-        context = {'module': module, 'user': user, 'site': get_domain_url()}
-        msg.send(context={'context': context})
+        _queue_email('payed', instance.enrollment.user_id, instance.enrollment.module_id)
+
+
+@timed('signal.update_aggregates_ms')
+def _update_modules_aggregates(modules):
+    from .catalog import invalidate_catalog
+    from .models import EducationalModule
+    module_ids = []
+    for module in modules:
+        module.update_aggregates()
+        module_ids.append(module.id)
+    EducationalModule.objects.invalidate_started_course_ids(module_ids)
+    if module_ids:
+        invalidate_catalog()
+
+
+def catalog_changed_handler(**kwargs):
+    """
+    сброс кэша каталога модулей при изменении модуля или варианта его прохождения
+    """
+    from .catalog import invalidate_catalog
+    if not kwargs.get('raw'):
+        invalidate_catalog()
+
+
+def course_changed_handler(**kwargs):
+    """
+    пересчет агрегатов модулей, в которые входит измененный курс
+    instance - Course
+    """
+    instance = kwargs.get('instance')
+    if instance and not kwargs.get('raw'):
+        _update_modules_aggregates(instance.education_modules.all())
+
+
+def course_pre_delete_handler(**kwargs):
+    """
+    запоминаем модули удаляемого курса: после удаления связи с ними уже не найти
+    instance - Course
+    """
+    instance = kwargs.get('instance')
+    if instance:
+        instance._edmodule_ids = list(instance.education_modules.values_list('id', flat=True))
+
+
+def course_deleted_handler(**kwargs):
+    """
+    пересчет агрегатов модулей, из которых удален курс
+    instance - Course
+    """
+    from .models import EducationalModule
+    instance = kwargs.get('instance')
+    module_ids = getattr(instance, '_edmodule_ids', None)
+    if module_ids:
+        _update_modules_aggregates(EducationalModule.objects.filter(id__in=module_ids))
+
+
+def course_session_pre_save_handler(**kwargs):
+    """
+    запоминаем значения полей сессии, от которых зависят агрегаты модулей, до изменения
+    instance - CourseSession
+    """
+    instance = kwargs.get('instance')
+    if instance and instance.pk and not kwargs.get('raw'):
+        instance._edmodule_old_fields = type(instance).objects.filter(pk=instance.pk).values_list(
+            *SESSION_AGGREGATE_FIELDS).first()
+
+
+def course_session_changed_handler(**kwargs):
+    """
+    сброс кэша кодекса чести сессии и, если изменились влияющие на них поля, пересчет агрегатов
+    модулей при создании, изменении или удалении сессии курса
+    instance - CourseSession
+    """
+    from .models import EducationalModule
+    from .utils import invalidate_session_honor_text
+    instance = kwargs.get('instance')
+    if not instance or not instance.course_id or kwargs.get('raw'):
+        return
+    invalidate_session_honor_text(instance)
+    old = getattr(instance, '_edmodule_old_fields', None)
+    new = tuple(getattr(instance, i) for i in SESSION_AGGREGATE_FIELDS)
+    instance._edmodule_old_fields = new
+    # post_save без изменений нужных полей; у post_delete аргумента created нет
+    if old == new and 'created' in kwargs:
+        return
+    course_ids = set([instance.course_id] + ([old[0]] if old else []))
+    _update_modules_aggregates(EducationalModule.objects.filter(courses__in=course_ids).distinct())
+
+
+def honor_code_changed_handler(**kwargs):
+    """
+    сброс кэша текстов кодекса чести
+    instance - HonorCode
+    """
+    from .utils import invalidate_honor_texts
+    if not kwargs.get('raw'):
+        invalidate_honor_texts()
+
+
+def course_relations_changed_handler(sender, instance, action, model, pk_set, **kwargs):
+    """
+    пересчет агрегатов модулей при изменении состава курсов модуля или преподавателей курса.
+    При clear связанные объекты запоминаются на pre_clear, на post_clear их уже нет
+    """
+    from .models import EducationalModule
+    if action == 'pre_clear':
+        if isinstance(instance, Course) and model is EducationalModule:
+            instance._edmodule_cleared = list(instance.education_modules.values_list('id', flat=True))
+        elif isinstance(instance, Instructor) and model is Course:
+            instance._edmodule_cleared = list(instance.instructor_courses.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_edmodule_cleared', [])
+
+    if isinstance(instance, EducationalModule) and model is Course:
+        modules = [instance]
+    elif isinstance(instance, Course) and model is EducationalModule:
+        modules = EducationalModule.objects.filter(id__in=pk_set)
+    elif isinstance(instance, Course) and model is Instructor:
+        modules = instance.education_modules.all()
+    elif isinstance(instance, Instructor) and model is Course:
+        modules = EducationalModule.objects.filter(courses__in=pk_set).distinct()
+    else:
+        return
+    _update_modules_aggregates(modules)
+
+
+def rating_pre_save_handler(**kwargs):
+    """
+    запоминаем, как отзыв учитывался в сводном рейтинге до изменения
+    instance - EducationalModuleRating
+    """
+    instance = kwargs.get('instance')
+    if instance and instance.pk and not kwargs.get('raw'):
+        try:
+            old = type(instance).objects.get(pk=instance.pk)
+            instance._edmodule_old_contribution = old.summary_contribution()
+        except type(instance).DoesNotExist:
+            pass
+
+
+def rating_saved_handler(**kwargs):
+    """
+    инкрементальное обновление сводного рейтинга модуля при создании, изменении и модерации отзыва
+    instance - EducationalModuleRating
+    """
+    from .catalog import invalidate_catalog
+    from .models import EducationalModuleRatingSummary
+    instance = kwargs.get('instance')
+    if not instance or kwargs.get('raw'):
+        return
+    old = getattr(instance, '_edmodule_old_contribution', None)
+    new = instance.summary_contribution()
+    instance._edmodule_old_contribution = new
+    if old == new:
+        return
+    if old:
+        EducationalModuleRatingSummary.objects.apply(old[0], old[1], -1)
+    if new:
+        EducationalModuleRatingSummary.objects.apply(new[0], new[1], 1)
+    invalidate_catalog()
+
+
+def rating_deleted_handler(**kwargs):
+    """
+    исключение удаленного отзыва из сводного рейтинга модуля
+    instance - EducationalModuleRating
+    """
+    from .catalog import invalidate_catalog
+    from .models import EducationalModuleRatingSummary
+    instance = kwargs.get('instance')
+    contribution = instance.summary_contribution() if instance else None
+    if contribution:
+        EducationalModuleRatingSummary.objects.apply(contribution[0], contribution[1], -1)
+        invalidate_catalog()
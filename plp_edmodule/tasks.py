@@ -1,13 +1,67 @@
 # coding: utf-8
 
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
+from celery import chain
 from celery.schedules import crontab
-from celery.task import periodic_task
+from celery.task import periodic_task, task
 from plp.models import CourseSession
-from .notifications import EdmoduleCourseStartsEmails, EdmoduleCourseEnrollEndsEmails
+from .models import EducationalModuleEnrollment, EducationalModuleNotification
+from .metrics import get_metrics, timed_task
+from .notifications import EdmoduleCourseStartsEmails, EdmoduleCourseEnrollEndsEmails, send_outbox_emails
+from .utils import sync_enrollments_progress, update_module_enrollment_progress
+
+ENROLL_JOB_DELAY = getattr(settings, 'EDMODULE_ENROLL_JOB_DELAY', 5)
+ENROLL_JOB_LOCK_TIMEOUT = getattr(settings, 'EDMODULE_ENROLL_JOB_LOCK_TIMEOUT', 300)
+PROGRESS_REFRESH_LOCK_TIMEOUT = getattr(settings, 'EDMODULE_PROGRESS_REFRESH_LOCK_TIMEOUT', 120)
+NOTIFICATION_PARALLELISM = getattr(settings, 'EDMODULE_NOTIFICATION_PARALLELISM', 4)
+
+NOTIFICATION_CLASSES = {
+    EducationalModuleNotification.KIND.COURSE_STARTS: EdmoduleCourseStartsEmails,
+    EducationalModuleNotification.KIND.COURSE_ENROLL_ENDS: EdmoduleCourseEnrollEndsEmails,
+}
+
+
+def _fan_out_notifications(session_ids, kind):
+    """
+    рассылка по каждой сессии - отдельная задача; задачи разбиваются на NOTIFICATION_PARALLELISM
+    цепочек, так что одновременно выполняется не больше NOTIFICATION_PARALLELISM рассылок
+    """
+    for i in range(NOTIFICATION_PARALLELISM):
+        bucket = session_ids[i::NOTIFICATION_PARALLELISM]
+        if bucket:
+            chain(*[send_module_course_notification.si(session_id, kind) for session_id in bucket]).apply_async()
+    logging.info('Queued {} module notifications for {} sessions'.format(kind, len(session_ids)))
+
+
+@task(bind=True, max_retries=3, default_retry_delay=300, ignore_result=True)
+@timed_task
+def send_module_course_notification(self, session_id, kind):
+    """
+    рассылка одного типа по одной сессии курса; при повторе уже отправленные письма
+    пропускаются благодаря журналу рассылок
+    """
+    started = time.time()
+    try:
+        session = CourseSession.objects.get(id=session_id)
+        sent = NOTIFICATION_CLASSES[kind](session).send()
+    except CourseSession.DoesNotExist:
+        return
+    except Exception as exc:
+        if self.request.retries >= self.max_retries:
+            logging.exception('Module notification {} for session {} failed'.format(kind, session_id))
+            return
+        raise self.retry(exc=exc)
+    get_metrics().incr('task.items', sent, task='send_module_course_notification')
+    logging.info('Module notification {} for session {}: {} sent in {:.2f}s'.format(
+        kind, session_id, sent, time.time() - started))
 
 
 @periodic_task(run_every=crontab(minute=0, hour=0))
+@timed_task
 def send_notification_module_course_starts():
     """
     периодическая проверка курсов, которые стартуют и отправка сообщений пользователям,
@@ -18,12 +72,11 @@ def send_notification_module_course_starts():
         timezone.make_aware(timezone.datetime.combine(now, timezone.datetime.min.time())),
         timezone.make_aware(timezone.datetime.combine(now, timezone.datetime.max.time()))
     ))
-    for cs in qs:
-        emails = EdmoduleCourseStartsEmails(cs)
-        emails.send()
+    _fan_out_notifications(list(qs.values_list('id', flat=True)), EducationalModuleNotification.KIND.COURSE_STARTS)
 
 
 @periodic_task(run_every=crontab(minute=0, hour=0))
+@timed_task
 def send_notification_module_course_enroll_ends():
     """
     периодическая проверка курсов, запись на которые заканчивается и отправка сообщений пользователям,
@@ -35,6 +88,99 @@ def send_notification_module_course_enroll_ends():
         timezone.make_aware(timezone.datetime.combine(now+td, timezone.datetime.min.time())),
         timezone.make_aware(timezone.datetime.combine(now+td, timezone.datetime.max.time()))
     ))
-    for cs in qs:
-        emails = EdmoduleCourseEnrollEndsEmails(cs)
-        emails.send()
+    _fan_out_notifications(list(qs.values_list('id', flat=True)),
+                           EducationalModuleNotification.KIND.COURSE_ENROLL_ENDS)
+
+
+@periodic_task(run_every=getattr(settings, 'EDMODULE_PROGRESS_SYNC_SCHEDULE', crontab(minute=30, hour='*/6')))
+@timed_task
+def sync_module_enrollments_progress():
+    """
+    периодическое обновление прогресса из edx по всем активным записям на модули
+    """
+    stats = sync_enrollments_progress()
+    get_metrics().incr('task.items', stats['total'], task='sync_module_enrollments_progress')
+    return stats
+
+
+@task(ignore_result=True)
+@timed_task
+def sync_enrollments_progress_task(enrollment_ids):
+    """
+    обновление прогресса из edx по указанным записям на модули (например, после массовой записи)
+    """
+    stats = sync_enrollments_progress(EducationalModuleEnrollment.objects.filter(id__in=enrollment_ids))
+    get_metrics().incr('task.items', stats['total'], task='sync_enrollments_progress_task')
+    return stats
+
+
+@periodic_task(run_every=timezone.timedelta(seconds=getattr(settings, 'EDMODULE_OUTBOX_INTERVAL', 60)))
+@timed_task
+def send_module_emails():
+    """
+    отправка писем из очереди транзакционных писем модулей
+    """
+    sent = send_outbox_emails()
+    get_metrics().incr('task.items', sent, task='send_module_emails')
+    return sent
+
+
+def _enrollment_job_key(user_id, module_id):
+    return 'edmodule_enrollment_job:{}:{}'.format(user_id, module_id)
+
+
+def schedule_module_enrollment_processing(enrollment):
+    """
+    постановка в очередь отложенной обработки записи на модуль. Пока задача для пары
+    (пользователь, модуль) ждет выполнения, повторные постановки игнорируются
+    """
+    if cache.add(_enrollment_job_key(enrollment.user_id, enrollment.module_id), 1, ENROLL_JOB_LOCK_TIMEOUT):
+        process_module_enrollment.apply_async(args=(enrollment.user_id, enrollment.module_id),
+                                              countdown=ENROLL_JOB_DELAY)
+
+
+@task(ignore_result=True)
+@timed_task
+def process_module_enrollment(user_id, module_id):
+    """
+    обновление прогресса из edx по записи на модуль вне запроса пользователя (письмо о записи
+    ставится в очередь в транзакции самой записи). Состояние записи читается в момент выполнения,
+    поэтому при многократной записи/отписке выполняется одна обработка (или ни одной, если
+    пользователь в итоге отписался)
+    """
+    cache.delete(_enrollment_job_key(user_id, module_id))
+    try:
+        enrollment = EducationalModuleEnrollment.objects.select_related('user', 'module').get(
+            user_id=user_id, module_id=module_id, is_active=True
+        )
+    except EducationalModuleEnrollment.DoesNotExist:
+        return
+    update_module_enrollment_progress(enrollment)
+
+
+def _progress_refresh_key(enrollment_id):
+    return 'edmodule_progress_refresh:{}'.format(enrollment_id)
+
+
+def schedule_progress_refresh(enrollment):
+    """
+    фоновое обновление прогресса по записи на модуль; пока обновление не завершилось,
+    повторные запросы на него игнорируются
+    """
+    if cache.add(_progress_refresh_key(enrollment.id), 1, PROGRESS_REFRESH_LOCK_TIMEOUT):
+        refresh_module_enrollment_progress.delay(enrollment.id)
+
+
+@task(ignore_result=True)
+@timed_task
+def refresh_module_enrollment_progress(enrollment_id):
+    """
+    обновление прогресса из edx по одной записи на модуль
+    """
+    try:
+        enrollment = EducationalModuleEnrollment.objects.select_related('user', 'module').get(id=enrollment_id)
+        update_module_enrollment_progress(enrollment)
+    except EducationalModuleEnrollment.DoesNotExist:
+        pass
+    finally:
+        cache.delete(_progress_refresh_key(enrollment_id))
@@ -1,24 +1,39 @@
 # coding: utf-8
 
 from django import template
-from plp.models import Participant
+from plp.models import Course
+from plp_edmodule.utils import get_button_status, load_next_sessions, load_participation
 
 register = template.Library()
 
 
+@register.simple_tag(takes_context=True)
+def load_enroll_buttons(context, items):
+    """
+    предварительная загрузка данных для последующих enroll_button на странице.
+    items - курсы (берется ближайшая сессия) или сессии
+    """
+    request = context['request']
+    courses = [i for i in items if isinstance(i, Course)]
+    next_sessions = load_next_sessions(request, courses)
+    load_participation(request, [next_sessions[i.id] if isinstance(i, Course) else i for i in items])
+    return ''
+
+
 @register.inclusion_tag('course/_enroll_button.html', takes_context=True)
 def enroll_button(context, course, session=None):
-    user = context['request'].user
+    request = context['request']
+    user = request.user
     authenticated = user.is_authenticated()
     if not session:
-        session = course.next_session
-    status = session.button_status(user) if session else course.button_status(user)
+        session = load_next_sessions(request, [course])[course.id]
+    status = get_button_status(request, course, session)
     honor_accepted, enrolled = False, False
     if session and authenticated:
-        p = Participant.objects.filter(session=session, user=user)
+        p = load_participation(request, [session])[session.id]
         if p:
             enrolled = True
-            honor_accepted = p[0].honor_code_accepted
+            honor_accepted = p.honor_code_accepted
     return {
         'status': status,
         'session': session,
@@ -28,5 +43,5 @@ def enroll_button(context, course, session=None):
         'authenticated': authenticated,
         'course_id': session.get_absolute_slug() if session else course.course_id(),
         'title': course.title,
-        'request': context['request'],
+        'request': request,
     }
@@ -0,0 +1,177 @@
+# coding: utf-8
+
+import threading
+from unittest import skipIf
+from django.core.cache import cache
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from plp.models import Course, CourseSession, University, User
+from .benchmark import build_instance, enroll_stress_check
+from .models import EducationalModule, EducationalModuleEnrollment
+from .utils import save_progress_bulk, update_graduation
+from .views import module_page, update_context_with_modules
+
+QUERY_BUDGET_SIZES = (1, 5, 20)
+
+
+class ModuleFixturesMixin(object):
+    """
+    модули из курсов с одной начавшейся сессией и пользователь
+    """
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.university = build_instance(University, 'university', slug='test-university', title='Test')
+        self.university.save()
+        self.user = build_instance(User, 'user', username='test-user', email='test-user@example.com')
+        self.user.save()
+        self.counter = 0
+
+    def make_course(self):
+        self.counter += 1
+        now = timezone.now()
+        course = build_instance(Course, 'course-{}'.format(self.counter),
+                                slug='test-course-{}'.format(self.counter),
+                                title='Test course {}'.format(self.counter), university=self.university)
+        course.save()
+        build_instance(CourseSession, 'session-{}'.format(self.counter), course=course, slug='test-session',
+                       datetime_starts=now - timezone.timedelta(days=1),
+                       datetime_ends=now + timezone.timedelta(days=30)).save()
+        return course
+
+    def make_module(self, courses):
+        self.counter += 1
+        module = build_instance(EducationalModule, 'module-{}'.format(self.counter),
+                                code='test-module-{}'.format(self.counter),
+                                title='Test module {}'.format(self.counter), about='Test module')
+        module.save()
+        module.courses.add(*[self.make_course() for _ in range(courses)])
+        return module
+
+
+class GraduationTest(ModuleFixturesMixin, TestCase):
+    """
+    завершение модуля по прогрессу, сохраненному под id сессий в edx
+    """
+    def test_passed_all_courses(self):
+        module = self.make_module(2)
+        enrollment = EducationalModuleEnrollment.objects.create(user=self.user, module=module, is_active=True)
+        session_ids = EducationalModule.objects.started_course_ids([module.id])[module.id]
+        self.assertEqual(len(session_ids), 2)
+        save_progress_bulk({enrollment.id: dict((k, {'passed': True, 'percent': 1}) for k in session_ids)},
+                           session_ids)
+        self.assertEqual(update_graduation([module.id]), 1)
+        self.assertTrue(EducationalModuleEnrollment.objects.get(id=enrollment.id).is_graduated)
+
+    def test_passed_some_courses(self):
+        module = self.make_module(2)
+        enrollment = EducationalModuleEnrollment.objects.create(user=self.user, module=module, is_active=True)
+        session_ids = EducationalModule.objects.started_course_ids([module.id])[module.id]
+        course_id = sorted(session_ids)[0]
+        save_progress_bulk({enrollment.id: {course_id: {'passed': True, 'percent': 1}}}, session_ids)
+        self.assertEqual(update_graduation([module.id]), 0)
+        self.assertFalse(EducationalModuleEnrollment.objects.get(id=enrollment.id).is_graduated)
+
+
+class ModuleQueryBudgetTest(ModuleFixturesMixin, TestCase):
+    """
+    число запросов страницы модуля и блока модулей пользователя не зависит от числа модулей и курсов
+    """
+    def request(self, path):
+        request = self.factory.get(path)
+        request.user = self.user
+        return request
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        return len(queries)
+
+    def assert_constant_queries(self, prepare):
+        """
+        prepare(n) создает данные размера n и возвращает проверяемую функцию;
+        число запросов для каждого размера должно совпадать с числом для наименьшего
+        """
+        budget = None
+        for n in QUERY_BUDGET_SIZES:
+            func = prepare(n)
+            cache.clear()
+            if budget is None:
+                budget = self.count_queries(func)
+                continue
+            with self.assertNumQueries(budget):
+                func()
+
+    def test_module_page(self):
+        def prepare(n):
+            module = self.make_module(n)
+            EducationalModuleEnrollment.objects.create(user=self.user, module=module, is_active=True)
+            return lambda: module_page(self.request('/edmodule/{}/'.format(module.code)), module.code)
+        self.assert_constant_queries(prepare)
+
+    def test_update_context_with_modules(self):
+        def prepare(n):
+            EducationalModuleEnrollment.objects.filter(user=self.user).delete()
+            for _ in range(n):
+                EducationalModuleEnrollment.objects.create(user=self.user, module=self.make_module(2),
+                                                           is_active=True)
+
+            def block():
+                context = {}
+                update_context_with_modules(context, self.user)
+                render_to_string('course/b_modules.html', context)
+            return block
+        self.assert_constant_queries(prepare)
+
+
+@skipIf(connection.vendor == 'sqlite', 'sqlite does not support concurrent writes from threads')
+class EnrollmentConcurrencyTest(TransactionTestCase):
+    """
+    одновременные запись и отписка одного пользователя на один модуль из нескольких потоков
+    """
+    def setUp(self):
+        self.user = build_instance(User, 'user', username='test-user', email='test-user@example.com')
+        self.user.save()
+        self.module = build_instance(EducationalModule, 'module', code='test-module', title='Test module',
+                                     about='Test module')
+        self.module.save()
+
+    def run_threads(self, target, count):
+        start = threading.Event()
+
+        def worker(n):
+            start.wait()
+            try:
+                target(n)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n, )) for n in range(count)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+
+    def test_concurrent_enroll_changes_state_once(self):
+        results, errors = [], []
+
+        def enroll(n):
+            try:
+                results.append(EducationalModuleEnrollment.objects.set_active(self.user, self.module, True)[1])
+            except Exception as exc:
+                errors.append(exc)
+
+        self.run_threads(enroll, 8)
+        self.assertEqual(errors, [])
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(EducationalModuleEnrollment.objects.filter(
+            user=self.user, module=self.module, is_active=True).count(), 1)
+
+    def test_concurrent_enroll_and_unenroll(self):
+        result = enroll_stress_check(self.user, self.module, threads=8, operations=25)
+        self.assertEqual(result['errors'], 0, result['error_samples'])
+        self.assertEqual(result['rows'], 1)
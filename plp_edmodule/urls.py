@@ -8,4 +8,7 @@ urlpatterns = [
     url(r'^edmodule-enroll/?$', views.edmodule_enroll, name='edmodule-enroll'),
     url(r'^edmodule/(?P<code>[-\w]+)/?$', views.module_page, name='edmodule-page'),
     url(r'get-honor-text/?$', views.get_honor_text, name='get-honor-text'),
+    url(r'get-honor-texts/?$', views.get_honor_texts_batch, name='get-honor-texts'),
+    url(r'^api/edmodules/?$', views.module_catalog, name='edmodule-catalog'),
+    url(r'^edmodule-export/enrollments/?$', views.export_enrollments_view, name='edmodule-export-enrollments'),
 ]
@@ -1,31 +1,171 @@
 # coding: utf-8
 
+import csv
 import logging
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, Count, IntegerField, Max, Q, Sum, When
 from django.utils import timezone
-from raven import Client
+from plp.models import CourseSession, HonorCode, Participant, User
 from plp.utils.edx_enrollment import EDXEnrollment, EDXNotAvailable, EDXCommunicationError, EDXEnrollmentError
-from plp.models import CourseSession
-from .models import EducationalModuleProgress
-
-RAVEN_CONFIG = getattr(settings, 'RAVEN_CONFIG', {})
-client = None
-
-if RAVEN_CONFIG:
-    client = Client(RAVEN_CONFIG.get('dsn'))
+from .metrics import get_metrics
+from .reporting import reporter
+from .signals import edmodule_graduated
+from .models import EducationalModule, EducationalModuleEnrollment, EducationalModuleProgress, \
+    EducationalModuleCourseProgress, EducationalModuleEnrollmentReason, EducationalModuleEmail, \
+    EducationalModuleProgressRollup
 
 REQUEST_TIMEOUT = 10
+RESPONSE_LOG_LIMIT = 500
+EDX_POOL_CONNECTIONS = getattr(settings, 'EDX_POOL_CONNECTIONS', 4)
+EDX_POOL_MAXSIZE = getattr(settings, 'EDX_POOL_MAXSIZE', 16)
+EDX_MAX_RETRIES = getattr(settings, 'EDX_MAX_RETRIES', 2)
+EDX_RETRY_BACKOFF = getattr(settings, 'EDX_RETRY_BACKOFF', 0.5)
+PROGRESS_SYNC_CONCURRENCY = getattr(settings, 'EDMODULE_PROGRESS_SYNC_CONCURRENCY', 8)
+PROGRESS_SYNC_CHUNK_SIZE = getattr(settings, 'EDMODULE_PROGRESS_SYNC_CHUNK_SIZE', 500)
+PROGRESS_TTL = getattr(settings, 'EDMODULE_PROGRESS_TTL', 15 * 60)
+PROGRESS_UPSERT_BATCH_SIZE = 1000
+BULK_ENROLL_CHUNK_SIZE = getattr(settings, 'EDMODULE_BULK_ENROLL_CHUNK_SIZE', 1000)
+RECONCILE_CHUNK_SIZE = 1000
+GRADUATION_CHUNK_SIZE = getattr(settings, 'EDMODULE_GRADUATION_CHUNK_SIZE', 5000)
+HONOR_TEXT_TTL = getattr(settings, 'EDMODULE_HONOR_TEXT_TTL', 24 * 60 * 60)
+HONOR_TEXT_VERSION_KEY = 'edmodule_honor_text_version'
 
 
 class EDXTimeoutError(EDXEnrollmentError):
     pass
 
 
+class CircuitBreaker(object):
+    """
+    размыкатель цепи для обращений к edx: после failure_threshold ошибок подряд запросы
+    не выполняются recovery_timeout секунд, затем пропускается один пробный запрос
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning('EDX circuit breaker opened after %s failures', self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opened_at': self.opened_at,
+                'rejected': self.rejected,
+            }
+
+
+edx_circuit_breaker = CircuitBreaker(
+    failure_threshold=getattr(settings, 'EDX_CIRCUIT_FAILURE_THRESHOLD', 5),
+    recovery_timeout=getattr(settings, 'EDX_CIRCUIT_RECOVERY_TIMEOUT', 30),
+)
+
+_edx_session = None
+_edx_session_lock = threading.Lock()
+
+
+def get_edx_session():
+    """
+    общая для процесса сессия requests с пулом keep-alive соединений к edx
+    """
+    global _edx_session
+    if _edx_session is None:
+        with _edx_session_lock:
+            if _edx_session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=EDX_POOL_CONNECTIONS,
+                    pool_maxsize=EDX_POOL_MAXSIZE,
+                    max_retries=0,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _edx_session = session
+    return _edx_session
+
+
+def edx_transport_stats():
+    """
+    состояние размыкателя цепи и пулов соединений к edx
+    """
+    pools = []
+    session = _edx_session
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            manager = getattr(adapter, 'poolmanager', None)
+            if manager is None:
+                continue
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                pools.append({
+                    'host': pool.host,
+                    'port': pool.port,
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    'idle': pool.pool.qsize() if pool.pool else 0,
+                    'maxsize': EDX_POOL_MAXSIZE,
+                })
+    return {'breaker': edx_circuit_breaker.stats(), 'pools': pools}
+
+
+def _retry_delay(attempt):
+    """
+    экспоненциальная задержка перед повтором со случайной составляющей (full jitter)
+    """
+    return random.uniform(0, EDX_RETRY_BACKOFF * (2 ** attempt))
+
+
 class EDXEnrollmentExtension(EDXEnrollment):
     """
-    расширение класса EDXEnrollment с обработкой таймаута
+    расширение класса EDXEnrollment с обработкой таймаута, повторами идемпотентных запросов
+    при ошибках соединения и ответах 5xx и размыканием цепи при недоступности edx
     """
+    def __init__(self, *args, **kwargs):
+        super(EDXEnrollmentExtension, self).__init__(*args, **kwargs)
+        self.session = get_edx_session()
+
     def request(self, path, method='GET', **kwargs):
         url = '%s%s' % (self.base_url, path)
 
@@ -45,35 +185,59 @@ class EDXEnrollmentExtension(EDXEnrollment):
             'method': method,
             'data': kwargs_copy,
         }
-        try:
-            logging.debug("EDXEnrollment.request %s %s %s", method, url, kwargs)
-            r = self.session.request(method=method, url=url, **kwargs)
-        except requests.exceptions.Timeout:
-            if client:
-                client.captureMessage('EDX connection timeout', extra=error_data)
-            logging.error('Edx connection timeout error: %s' % error_data)
+        metrics = get_metrics()
+        endpoint = path.split('?', 1)[0]
+        if not edx_circuit_breaker.allow_request():
+            logging.warning('EDX circuit breaker is open, request %s %s skipped', method, path)
+            metrics.incr('edx.rejected', endpoint=endpoint)
+            raise EDXNotAvailable('EDX circuit breaker is open')
+        # таймаут не повторяется: иначе синхронный запрос мог бы ждать несколько таймаутов подряд
+        attempts = EDX_MAX_RETRIES + 1 if method == 'GET' else 1
+        r, error = None, None
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(_retry_delay(attempt))
+            started = time.time()
+            try:
+                logging.debug("EDXEnrollment.request %s %s %s", method, url, kwargs)
+                r, error = self.session.request(method=method, url=url, **kwargs), None
+            except IOError as exc:
+                r, error = None, exc
+            if metrics.enabled:
+                if r is not None:
+                    status = r.status_code
+                else:
+                    status = 'timeout' if isinstance(error, requests.exceptions.Timeout) else 'error'
+                metrics.timing('edx.request_ms', (time.time() - started) * 1000, endpoint=endpoint, method=method,
+                               status=status)
+            if (r is not None and r.status_code < 500) or isinstance(error, requests.exceptions.Timeout):
+                break
+        # в размыкатель цепи попадает результат вызова целиком, а не каждая попытка
+        if r is not None and r.status_code < 500:
+            edx_circuit_breaker.record_success()
+        else:
+            edx_circuit_breaker.record_failure()
+
+        if isinstance(error, requests.exceptions.Timeout):
+            reporter.report('EDX connection timeout', fingerprint='edx:timeout:{}'.format(endpoint), **error_data)
             raise EDXTimeoutError('')
-        except IOError as exc:
-            error_data['exception'] = str(exc)
-            if client:
-                client.captureMessage('EDXNotAvailable', extra=error_data)
-            logging.error('EDXNotAvailable error: %s' % error_data)
-            raise EDXNotAvailable("Error: {}".format(exc))
+        if error is not None:
+            error_data['exception'] = str(error)
+            reporter.report('EDXNotAvailable', fingerprint='edx:unavailable:{}'.format(endpoint), **error_data)
+            raise EDXNotAvailable("Error: {}".format(error))
 
-        logging.debug("EDXEnrollment.request response=%s %s", r.status_code, r.content)
+        content = r.content[:RESPONSE_LOG_LIMIT]
+        logging.debug("EDXEnrollment.request response=%s %s", r.status_code, content)
 
-        error_data.update({'status_code': r.status_code, 'content': r.content})
+        error_data.update({'status_code': r.status_code, 'content': content})
         if 500 <= r.status_code:
-            if client:
-                client.captureMessage('EDXNotAvailable', extra=error_data)
-            logging.error('EDXNotAvailable error: %s' % error_data)
-            raise EDXNotAvailable("Invalid EDX http response: {} {}".format(r.status_code, r.content))
+            reporter.report('EDXNotAvailable', fingerprint='edx:{}:{}'.format(r.status_code, endpoint), **error_data)
+            raise EDXNotAvailable("Invalid EDX http response: {} {}".format(r.status_code, content))
 
         if r.status_code != 200:
-            if client:
-                client.captureMessage('EDXCommunicationError', extra=error_data)
-            logging.error('EDXCommunicationError error: %s' % error_data)
-            raise EDXCommunicationError("Invalid EDX http response: {} {}".format(r.status_code, r.content))
+            reporter.report('EDXCommunicationError', fingerprint='edx:{}:{}'.format(r.status_code, endpoint),
+                            **error_data)
+            raise EDXCommunicationError("Invalid EDX http response: {} {}".format(r.status_code, content))
 
         return r
 
@@ -89,25 +253,542 @@ class EDXEnrollmentExtension(EDXEnrollment):
         )
 
 
-def update_module_enrollment_progress(enrollment):
+def get_started_sessions(module):
+    """
+    начавшиеся сессии курсов модуля: словарь {id сессии в edx: id сессии}
+    """
+    return EducationalModule.objects.started_course_ids([module.id])[module.id]
+
+
+def _mark_progress_updated(data):
+    now = timezone.now().strftime('%H:%M:%S %Y-%m-%d')
+    for k, v in data.iteritems():
+        v['updated_at'] = now
+    return data
+
+
+def _course_progress_fields(value):
+    """
+    поля прогресса по курсу, по которым нужны выборки, извлеченные из ответа edx
+    """
+    grade = value.get('percent')
+    try:
+        grade = float(grade) if grade is not None else None
+    except (TypeError, ValueError):
+        grade = None
+    return {'data': value, 'passed': bool(value.get('passed')), 'grade': grade}
+
+
+def upsert_course_progress(enrollment_id, course_id, fields):
+    """
+    запись прогресса по одной сессии курса: обновление строки, а если ее нет - вставка
+    """
+    qs = EducationalModuleCourseProgress.objects.filter(enrollment_id=enrollment_id, course_id=course_id)
+    if qs.update(updated_at=timezone.now(), **fields):
+        return
+    try:
+        with transaction.atomic():
+            EducationalModuleCourseProgress.objects.create(enrollment_id=enrollment_id, course_id=course_id,
+                                                           **fields)
+    except IntegrityError:
+        qs.update(updated_at=timezone.now(), **fields)
+
+
+def _upsert_course_progress_rows(rows):
     """
-    обновление прогресса из edx по сессиям курсов, входящих в модуль, на который записан пользователь
+    вставка или обновление строк прогресса по курсам одним INSERT ... ON CONFLICT на порцию
+    из PROGRESS_UPSERT_BATCH_SIZE строк (postgresql 9.5+). Ссылка на сессию обновляется,
+    только если она известна
+    rows - список (id записи на модуль, id сессии в edx, поля)
     """
-    module = enrollment.module
-    sessions = CourseSession.objects.filter(course__in=module.courses.all())
-    course_ids = [s.get_absolute_slug_v1() for s in sessions if s.course_status().get('code') == 'started']
+    model = EducationalModuleCourseProgress
+    qn = connection.ops.quote_name
+    columns = ['enrollment_id', 'course_id', 'session_id', 'passed', 'grade', 'data', 'updated_at']
+    db_fields = [model._meta.get_field(i) for i in ('enrollment', 'course_id', 'session', 'passed', 'grade',
+                                                     'data', 'updated_at')]
+    sql = (
+        'INSERT INTO {table} ({columns}) VALUES {{values}} '
+        'ON CONFLICT (enrollment_id, course_id) DO UPDATE SET '
+        'session_id = COALESCE(EXCLUDED.session_id, {table}.session_id), passed = EXCLUDED.passed, '
+        'grade = EXCLUDED.grade, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at'
+    ).format(table=qn(model._meta.db_table), columns=', '.join(qn(i) for i in columns))
+    placeholder = '({})'.format(', '.join(['%s'] * len(columns)))
+    now = timezone.now()
+    cursor = connection.cursor()
+    for i in range(0, len(rows), PROGRESS_UPSERT_BATCH_SIZE):
+        batch = rows[i:i + PROGRESS_UPSERT_BATCH_SIZE]
+        params = []
+        for enrollment_id, course_id, fields in batch:
+            values = [enrollment_id, course_id, fields.get('session_id'), fields['passed'], fields['grade'],
+                      fields['data'], now]
+            params.extend(f.get_db_prep_save(v, connection) for f, v in zip(db_fields, values))
+        cursor.execute(sql.format(values=', '.join([placeholder] * len(batch))), params)
+
+
+def _save_course_progress_rows(enrollment_ids, rows):
+    """
+    запись строк прогресса по курсам без ON CONFLICT: новые - одним bulk_create, существующие - построчно
+    """
+    existing = set(EducationalModuleCourseProgress.objects.filter(
+        enrollment_id__in=enrollment_ids).values_list('enrollment_id', 'course_id'))
+    new_rows = []
+    with transaction.atomic():
+        for enrollment_id, course_id, fields in rows:
+            if (enrollment_id, course_id) in existing:
+                upsert_course_progress(enrollment_id, course_id, fields)
+            else:
+                new_rows.append((enrollment_id, course_id, fields))
     try:
-        data = EDXEnrollmentExtension().get_courses_progress(enrollment.user.username, course_ids).json()
-        now = timezone.now().strftime('%H:%M:%S %Y-%m-%d')
-        for k, v in data.iteritems():
-            v['updated_at'] = now
+        with transaction.atomic():
+            EducationalModuleCourseProgress.objects.bulk_create([
+                EducationalModuleCourseProgress(enrollment_id=enrollment_id, course_id=course_id, **fields)
+                for enrollment_id, course_id, fields in new_rows
+            ])
+    except IntegrityError:
+        for enrollment_id, course_id, fields in new_rows:
+            upsert_course_progress(enrollment_id, course_id, fields)
+
+
+def save_progress_bulk(progress_by_enrollment, session_ids=None):
+    """
+    запись прогресса для нескольких записей на модуль. На postgresql строки прогресса по курсам
+    вставляются или обновляются одним INSERT ... ON CONFLICT на порцию; на других базах новые строки
+    создаются одним bulk_create, существующие обновляются построчно
+    progress_by_enrollment - словарь {id записи на модуль: данные из edx}
+    session_ids - словарь {id сессии в edx: id сессии}
+    """
+    if not progress_by_enrollment:
+        return
+    session_ids = session_ids or {}
+    enrollment_ids = list(progress_by_enrollment.keys())
+    rows = []
+    for enrollment_id, data in progress_by_enrollment.iteritems():
+        for course_id, value in data.iteritems():
+            fields = _course_progress_fields(value)
+            if course_id in session_ids:
+                fields['session_id'] = session_ids[course_id]
+            rows.append((enrollment_id, course_id, fields))
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            _upsert_course_progress_rows(rows)
+    else:
+        _save_course_progress_rows(enrollment_ids, rows)
+
+    headers = EducationalModuleProgress.objects.filter(enrollment_id__in=enrollment_ids)
+    headers.update(updated_at=timezone.now())
+    missing = set(enrollment_ids) - set(headers.values_list('enrollment_id', flat=True))
+    try:
+        with transaction.atomic():
+            EducationalModuleProgress.objects.bulk_create([
+                EducationalModuleProgress(enrollment_id=enrollment_id) for enrollment_id in missing
+            ])
+    except IntegrityError:
+        pass
+
+
+def _count_if(**lookups):
+    return Sum(Case(When(then=1, **lookups), default=0, output_field=IntegerField()))
+
+
+def update_progress_rollups(module_ids, day=None, course_ids=None):
+    """
+    пересчет дневного среза прогресса по модулям: один запрос с группировкой по (модуль, сессия курса)
+    по активным записям и обновление строки среза за день для каждой пары.
+    course_ids - только эти сессии курсов (те, прогресс по которым изменился)
+    """
+    if not module_ids or course_ids is not None and not course_ids:
+        return
+    now = timezone.now()
+    day = day or now.date()
+    progress = EducationalModuleCourseProgress.objects.filter(
+        enrollment__is_active=True, enrollment__module__in=module_ids)
+    if course_ids is not None:
+        progress = progress.filter(course_id__in=course_ids)
+    rows = progress.values('enrollment__module_id', 'course_id').annotate(
+        session=Max('session_id'),
+        started=Count('id'),
+        passing=_count_if(passed=True),
+        finished=_count_if(passed=True, session__datetime_ends__lt=now),
+    ).order_by()
+    for row in rows:
+        module_id, course_id = row['enrollment__module_id'], row['course_id']
+        fields = {
+            'session_id': row['session'],
+            'started': row['started'],
+            'passing': row['passing'] or 0,
+            'finished': row['finished'] or 0,
+        }
+        qs = EducationalModuleProgressRollup.objects.filter(module_id=module_id, course_id=course_id, day=day)
+        if qs.update(updated_at=now, **fields):
+            continue
         try:
-            progress = EducationalModuleProgress.objects.get(enrollment=enrollment)
-            p = progress.progress or {}
-            p.update(data)
-            progress.progress = p
-            progress.save()
-        except EducationalModuleProgress.DoesNotExist:
-            EducationalModuleProgress.objects.create(enrollment=enrollment, progress=data)
+            with transaction.atomic():
+                EducationalModuleProgressRollup.objects.create(module_id=module_id, course_id=course_id, day=day,
+                                                               **fields)
+        except IntegrityError:
+            qs.update(updated_at=now, **fields)
+
+
+def update_graduation(module_ids=None, chunk_size=None):
+    """
+    отметка завершения модуля по сохраненному прогрессу: запись считается завершенной, если
+    засчитаны все курсы модуля. Курс прогресса определяется по id сессии в edx среди всех сессий
+    курсов модуля (не только начавшихся), так что учитываются и строки без ссылки на сессию.
+    Записи просматриваются порциями, завершенные отмечаются одним UPDATE на порцию, сигнал
+    edmodule_graduated отправляется только для действительно измененных.
+    Возвращает количество отмеченных записей
+    """
+    chunk_size = chunk_size or GRADUATION_CHUNK_SIZE
+    modules = EducationalModule.objects.filter(courses_count__gt=0)
+    if module_ids is not None:
+        modules = modules.filter(id__in=module_ids)
+    total = 0
+    for module_id, courses_count in modules.values_list('id', 'courses_count'):
+        course_by_session = dict(
+            (session.get_absolute_slug_v1(), session.course_id)
+            for session in CourseSession.objects.filter(course__education_modules=module_id).select_related(
+                'course__university')
+        )
+        if not course_by_session:
+            continue
+        pending = EducationalModuleEnrollment.objects.filter(module_id=module_id, is_active=True, is_graduated=False)
+        last_id = 0
+        while True:
+            ids = list(pending.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            passed = {}
+            for enrollment_id, course_id in EducationalModuleCourseProgress.objects.filter(
+                    enrollment__in=ids, passed=True, course_id__in=course_by_session.keys()
+            ).values_list('enrollment_id', 'course_id'):
+                passed.setdefault(enrollment_id, set()).add(course_by_session[course_id])
+            graduated = [k for k, v in passed.items() if len(v) >= courses_count]
+            if not graduated:
+                continue
+            with transaction.atomic():
+                changed = list(pending.select_for_update().filter(id__in=graduated).values_list('id', flat=True))
+                EducationalModuleEnrollment.objects.filter(id__in=changed).update(
+                    is_graduated=True, updated_at=timezone.now())
+            total += len(changed)
+            for enrollment in EducationalModuleEnrollment.objects.filter(id__in=changed).select_related(
+                    'user', 'module'):
+                edmodule_graduated.send(EducationalModuleEnrollment, instance=enrollment)
+    if total:
+        logging.info('Educational module graduation: {} enrollments graduated'.format(total))
+    return total
+
+
+def update_module_enrollment_progress(enrollment):
+    """
+    обновление прогресса из edx по сессиям курсов, входящих в модуль, на который записан пользователь,
+    и строк дневного среза по сессиям, прогресс по которым получен
+    """
+    session_ids = get_started_sessions(enrollment.module)
+    try:
+        data = EDXEnrollmentExtension().get_courses_progress(enrollment.user.username, session_ids.keys()).json()
     except EDXEnrollmentError:
-        pass
+        return
+    save_progress_bulk({enrollment.id: _mark_progress_updated(data)}, session_ids)
+    update_progress_rollups([enrollment.module_id], course_ids=list(data.keys()))
+
+
+def get_module_enrollment_progress(enrollment, force_refresh=False):
+    """
+    прогресс по записи на модуль с чтением через кэш. Сохраненные данные моложе PROGRESS_TTL
+    отдаются сразу; устаревшие тоже отдаются, но ставится фоновое обновление (одно на запись).
+    Синхронно edx опрашивается только при force_refresh или если сохраненных данных нет
+    """
+    progress = EducationalModuleProgress.objects.filter(enrollment=enrollment).first()
+    if force_refresh or progress is None:
+        update_module_enrollment_progress(enrollment)
+        progress = EducationalModuleProgress.objects.filter(enrollment=enrollment).first()
+    elif timezone.now() - progress.updated_at > timezone.timedelta(seconds=PROGRESS_TTL):
+        from .tasks import schedule_progress_refresh
+        schedule_progress_refresh(enrollment)
+    return progress.progress if progress else None
+
+
+_sync_local = threading.local()
+
+
+def _fetch_progress(item):
+    """
+    запрос прогресса одного пользователя из потока пула; к базе данных не обращается
+    """
+    enrollment_id, username, course_ids = item
+    edx = getattr(_sync_local, 'edx', None)
+    if edx is None:
+        edx = _sync_local.edx = EDXEnrollmentExtension()
+    try:
+        return enrollment_id, edx.get_courses_progress(username, course_ids).json()
+    except (EDXEnrollmentError, ValueError) as exc:
+        logging.warning('Progress sync failed for enrollment {}: {}'.format(enrollment_id, exc))
+        return enrollment_id, None
+
+
+def sync_enrollments_progress(enrollments=None, concurrency=None, chunk_size=None):
+    """
+    массовое обновление прогресса из edx по всем активным записям на модули.
+    Набор начавшихся сессий вычисляется один раз на модуль и общий для всех его записей,
+    запросы в edx выполняются пулом из concurrency потоков, результаты пишутся пачками.
+    Возвращает статистику прогона.
+    """
+    concurrency = concurrency or PROGRESS_SYNC_CONCURRENCY
+    chunk_size = chunk_size or PROGRESS_SYNC_CHUNK_SIZE
+    if enrollments is None:
+        enrollments = EducationalModuleEnrollment.objects.filter(is_active=True)
+    started = time.time()
+    stats = {'total': 0, 'synced': 0, 'failed': 0, 'skipped': 0}
+    course_ids_by_module = {}
+    session_ids = {}
+    synced_modules = set()
+    pool = ThreadPool(concurrency)
+    try:
+        last_id = 0
+        while True:
+            chunk = list(enrollments.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'module_id', 'user__username')[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            stats['total'] += len(chunk)
+            missing = set(i[1] for i in chunk) - set(course_ids_by_module)
+            if missing:
+                for module_id, module_sessions in EducationalModule.objects.started_course_ids(missing).iteritems():
+                    session_ids.update(module_sessions)
+                    course_ids_by_module[module_id] = tuple(sorted(module_sessions))
+            items = []
+            for enrollment_id, module_id, username in chunk:
+                course_ids = course_ids_by_module[module_id]
+                if not course_ids:
+                    stats['skipped'] += 1
+                    continue
+                items.append((enrollment_id, username, course_ids))
+            results = {}
+            module_by_enrollment = dict((i[0], i[1]) for i in chunk)
+            for enrollment_id, data in pool.imap_unordered(_fetch_progress, items):
+                if data is None:
+                    stats['failed'] += 1
+                else:
+                    results[enrollment_id] = _mark_progress_updated(data)
+                    synced_modules.add(module_by_enrollment[enrollment_id])
+            save_progress_bulk(results, session_ids)
+            stats['synced'] += len(results)
+    finally:
+        pool.close()
+        pool.join()
+    update_progress_rollups(synced_modules)
+    stats['graduated'] = update_graduation(synced_modules)
+    stats['seconds'] = round(time.time() - started, 3)
+    stats['rate'] = round(stats['total'] / stats['seconds'], 2) if stats['seconds'] else stats['total']
+    logging.info('Module progress sync: {total} enrollments, {synced} synced, {failed} failed, '
+                 '{skipped} skipped, {graduated} graduated in {seconds}s ({rate} enrollments/s)'.format(**stats))
+    return stats
+
+
+def parse_usernames(lines):
+    """
+    логины пользователей из строк csv (первая колонка) или списка; строка заголовка пропускается
+    """
+    usernames = []
+    for row in csv.reader(lines):
+        if row and row[0].strip() and row[0].strip().lower() != 'username':
+            usernames.append(row[0].strip())
+    return usernames
+
+
+def bulk_enroll_users(module, usernames, enrollment_type=None, payment_type=None, payment_order_id=None,
+                      payment_descriptions=None, is_paid=False, chunk_size=None):
+    """
+    массовая запись пользователей на модуль. Записи, причины записи и письма о записи создаются
+    через bulk_create порциями по chunk_size, неактивные записи активируются одним UPDATE, активные
+    пропускаются; прогресс из edx по новым и активированным записям запрашивается фоновой задачей.
+    Возвращает статистику: создано записей, активировано, пропущено активных, неизвестные логины
+    """
+    from .tasks import sync_enrollments_progress_task
+    chunk_size = chunk_size or BULK_ENROLL_CHUNK_SIZE
+    usernames = list(set(usernames))
+    if payment_type == EducationalModuleEnrollmentReason.PAYMENT_TYPE.YAMONEY and payment_order_id and \
+            len(usernames) > 1:
+        # номер заказа яндекс-кассы уникален, один номер нельзя записать в причины нескольких записей
+        raise ValueError('Yandex.Kassa order id can not be shared by several enrollments')
+    stats = {'created': 0, 'reactivated': 0, 'existing': 0, 'unknown': []}
+    for i in range(0, len(usernames), chunk_size):
+        chunk = usernames[i:i + chunk_size]
+        users = dict(User.objects.filter(username__in=chunk).values_list('id', 'username'))
+        stats['unknown'].extend(set(chunk) - set(users.values()))
+        with transaction.atomic():
+            existing = dict(EducationalModuleEnrollment.objects.select_for_update().filter(
+                module=module, user__in=users.keys()).values_list('user_id', 'is_active'))
+            new_user_ids = [u for u in users if u not in existing]
+            inactive_user_ids = [u for u, is_active in existing.items() if not is_active]
+            EducationalModuleEnrollment.objects.bulk_create([
+                EducationalModuleEnrollment(user_id=u, module=module, is_active=True, is_paid=is_paid)
+                for u in new_user_ids
+            ])
+            fields = {'is_active': True, 'updated_at': timezone.now()}
+            if is_paid:
+                fields['is_paid'] = True
+            EducationalModuleEnrollment.objects.filter(module=module, user__in=inactive_user_ids).update(**fields)
+            created = list(EducationalModuleEnrollment.objects.filter(
+                module=module, user__in=new_user_ids + inactive_user_ids).values_list('id', 'user_id'))
+            if enrollment_type:
+                EducationalModuleEnrollmentReason.objects.bulk_create([
+                    EducationalModuleEnrollmentReason(
+                        enrollment_id=enrollment_id,
+                        module_enrollment_type=enrollment_type,
+                        payment_type=payment_type,
+                        payment_order_id=payment_order_id,
+                        payment_descriptions=payment_descriptions,
+                    ) for enrollment_id, user_id in created
+                ])
+            EducationalModuleEmail.objects.bulk_create([
+                EducationalModuleEmail(kind=EducationalModuleEmail.KIND.ENROLLED, user_id=user_id, module=module)
+                for enrollment_id, user_id in created
+            ])
+        stats['created'] += len(new_user_ids)
+        stats['reactivated'] += len(inactive_user_ids)
+        stats['existing'] += len(existing) - len(inactive_user_ids)
+        if created:
+            sync_enrollments_progress_task.delay([enrollment_id for enrollment_id, user_id in created])
+    logging.info('Bulk enrollment into module {}: {} created, {} reactivated, {} existing, {} unknown users'.format(
+        module.code, stats['created'], stats['reactivated'], stats['existing'], len(stats['unknown'])))
+    return stats
+
+
+def reconcile_payments(payments, payment_type, dry_run=False):
+    """
+    сверка выгрузки платежей с причинами записи на модуль. payments - словарь {номер заказа: сумма или None}.
+    Записи по найденным заказам отмечаются оплаченными одним UPDATE на порцию; уже оплаченные
+    не трогаются, поэтому повторная сверка того же файла ничего не меняет. Заказы, сумма которых
+    не совпадает со стоимостью варианта прохождения, оплаченными не отмечаются, а только попадают в отчет.
+    Возвращает статистику и расхождения: заказы без причины записи и заказы с другой суммой
+    """
+    order_ids = list(payments.keys())
+    stats = {'total': len(order_ids), 'matched': 0, 'marked_paid': 0, 'already_paid': 0,
+             'missing': [], 'amount_mismatch': []}
+    for i in range(0, len(order_ids), RECONCILE_CHUNK_SIZE):
+        chunk = order_ids[i:i + RECONCILE_CHUNK_SIZE]
+        rows = EducationalModuleEnrollmentReason.objects.filter(
+            payment_type=payment_type, payment_order_id__in=chunk
+        ).values_list('payment_order_id', 'enrollment_id', 'enrollment__is_paid', 'module_enrollment_type__price')
+        found, unpaid = set(), set()
+        for order_id, enrollment_id, is_paid, price in rows:
+            found.add(order_id)
+            amount = payments[order_id]
+            mismatch = amount is not None and price is not None and int(round(amount)) != price
+            if mismatch:
+                stats['amount_mismatch'].append((order_id, amount, price))
+            if is_paid:
+                stats['already_paid'] += 1
+            elif not mismatch:
+                unpaid.add(enrollment_id)
+        stats['matched'] += len(found)
+        stats['missing'].extend(sorted(set(chunk) - found))
+        if unpaid and not dry_run:
+            stats['marked_paid'] += EducationalModuleEnrollment.objects.filter(
+                id__in=unpaid, is_paid=False).update(is_paid=True, updated_at=timezone.now())
+        elif dry_run:
+            stats['marked_paid'] += len(unpaid)
+    logging.info('Payment reconciliation ({}): {} orders, {} matched, {} marked paid, {} missing'.format(
+        payment_type, stats['total'], stats['matched'], stats['marked_paid'], len(stats['missing'])))
+    return stats
+
+
+def invalidate_honor_texts():
+    """
+    сброс кэша текстов кодекса чести: меняется версия, входящая в ключи кэша
+    """
+    cache.set(HONOR_TEXT_VERSION_KEY, int(time.time() * 1000), None)
+
+
+def _honor_text_key(version, course_id):
+    return 'edmodule_honor_text:{}:{}'.format(version, course_id)
+
+
+def _session_course_id(session):
+    return '/'.join([session.course.university.slug, session.course.slug, session.slug])
+
+
+def invalidate_session_honor_text(session):
+    """
+    сброс кэшированного текста кодекса чести одной сессии
+    """
+    cache.delete(_honor_text_key(cache.get(HONOR_TEXT_VERSION_KEY, 0), _session_course_id(session)))
+
+
+def get_honor_texts(course_ids):
+    """
+    тексты кодекса чести для сессий {course_id: текст}, course_id вида "вуз/курс/сессия".
+    Тексты кэшируются по сессиям; сессии, которых нет в кэше, выбираются одним запросом,
+    а их тексты - через HonorCode.objects.get_text_for_session по одной сессии.
+    Ненайденные сессии в результат не попадают
+    """
+    version = cache.get(HONOR_TEXT_VERSION_KEY, 0)
+    keys = dict((_honor_text_key(version, i), i) for i in course_ids)
+    result = dict((keys[k], v) for k, v in cache.get_many(keys.keys()).iteritems())
+    missing = [i.split('/') for i in set(course_ids) - set(result)]
+    if missing:
+        q = Q()
+        for university, course, session in missing:
+            q |= Q(course__university__slug=university, course__slug=course, slug=session)
+        sessions = list(CourseSession.objects.filter(q).select_related('course__university'))
+        found = dict((_session_course_id(s), HonorCode.objects.get_text_for_session(s)) for s in sessions)
+        cache.set_many(dict((_honor_text_key(version, k), v) for k, v in found.iteritems()), HONOR_TEXT_TTL)
+        result.update(found)
+    return result
+
+
+def _request_cache(request, name):
+    cache = getattr(request, name, None)
+    if cache is None:
+        cache = {}
+        setattr(request, name, cache)
+    return cache
+
+
+def load_participation(request, sessions):
+    """
+    записи пользователя на сессии {id сессии: Participant или None}; сессии, которых еще нет
+    в кэше запроса, загружаются одним запросом
+    """
+    participation = _request_cache(request, '_edmodule_participation')
+    ids = set(s.id for s in sessions if s and s.id not in participation)
+    if ids and request.user.is_authenticated():
+        participation.update(dict.fromkeys(ids))
+        for p in Participant.objects.filter(session__in=ids, user=request.user):
+            participation[p.session_id] = p
+    return participation
+
+
+def load_next_sessions(request, courses):
+    """
+    ближайшие сессии курсов {id курса: сессия или None} - те, для которых выводятся кнопки записи;
+    для каждого курса вычисляется один раз за запрос
+    """
+    next_sessions = _request_cache(request, '_edmodule_next_session')
+    for course in courses:
+        if course.id not in next_sessions:
+            next_sessions[course.id] = course.next_session
+    return next_sessions
+
+
+def get_button_status(request, course, session):
+    """
+    статус кнопки записи на сессию (или курс без сессии), не больше одного вычисления
+    на сессию за запрос
+    """
+    statuses = _request_cache(request, '_edmodule_button_status')
+    key = ('session', session.id) if session else ('course', course.id)
+    if key not in statuses:
+        statuses[key] = session.button_status(request.user) if session else course.button_status(request.user)
+    return statuses[key]
+
+
+def preload_enroll_buttons(request, courses):
+    """
+    записи пользователя на ближайшие сессии курсов, для которых на странице выводятся кнопки
+    записи, загружаются одним запросом, а не по запросу на кнопку
+    """
+    load_participation(request, load_next_sessions(request, courses).values())
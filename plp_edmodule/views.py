@@ -1,18 +1,46 @@
 # coding: utf-8
 
+import hashlib
 import logging
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET, require_POST
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.db.models import Prefetch
 from django.shortcuts import get_object_or_404, render
-from plp.models import HonorCode, CourseSession
+from plp.models import Course, CourseSession
+from .metrics import instrument_view
+from .export import FORMATS, export_enrollments
+from .catalog import CATALOG_MAX_PAGE_SIZE, CATALOG_PAGE_SIZE, catalog_version, get_catalog_page_json
 from .models import EducationalModule, EducationalModuleEnrollment
-from .utils import update_module_enrollment_progress, client
+from .reporting import reporter
+from .utils import get_honor_texts, preload_enroll_buttons, update_module_enrollment_progress
 from .signals import edmodule_enrolled
+from .tasks import schedule_module_enrollment_processing
 
+DEFER_ENROLL_SIDE_EFFECTS = getattr(settings, 'EDMODULE_DEFER_ENROLL_SIDE_EFFECTS', False)
+COURSE_SESSIONS = CourseSession._meta.get_field('course').rel.get_accessor_name()
+HONOR_TEXTS_BATCH_LIMIT = 100
 
+
+def _process_enrollment(enrollment):
+    """
+    обновление прогресса после записи: сразу или фоновой задачей, если включен отложенный режим
+    """
+    if DEFER_ENROLL_SIDE_EFFECTS:
+        schedule_module_enrollment_processing(enrollment)
+    else:
+        update_module_enrollment_progress(enrollment)
+
+
+@instrument_view('edmodule_enroll')
 @login_required
 @require_POST
+@transaction.non_atomic_requests
 def edmodule_enroll(request):
     """
     обработка подписки и отписки от образовательного модуля
@@ -26,37 +54,27 @@ def edmodule_enroll(request):
     if ed_module_code:
         try:
             edmodule = EducationalModule.objects.get(code=ed_module_code)
-            try:
-                enrollment = EducationalModuleEnrollment.objects.get(user=request.user, module=edmodule)
-                if enrollment.is_active and is_active:
+            # запись и письмо о ней в очереди сохраняются в одной транзакции
+            with transaction.atomic():
+                enrollment, changed = EducationalModuleEnrollment.objects.set_active(
+                    request.user, edmodule, is_active)
+                if changed and is_active:
+                    edmodule_enrolled.send(EducationalModuleEnrollment, instance=enrollment)
+            if not changed:
+                if is_active:
                     logging.info('User {} already enrolled in educational module {}'.format(
                         request.user.username, edmodule.code
                     ))
-                    return JsonResponse({'status': 1})
-                elif not enrollment.is_active and not is_active:
+                elif EducationalModuleEnrollment.objects.filter(user=request.user, module=edmodule).exists():
                     logging.info('User {} already unenrolled from educational module {}'.format(
                         request.user.username, edmodule.code
                     ))
-                    return JsonResponse({'status': 1})
-                enrollment.is_active = is_active
-                enrollment.save()
-                if is_active:
-                    update_module_enrollment_progress(enrollment)
-                    edmodule_enrolled.send(EducationalModuleEnrollment, instance=enrollment)
-            except EducationalModuleEnrollment.DoesNotExist:
-                if not is_active:
-                    if client:
-                        client.captureMessage('User without active enrollment tried to unenroll from module',
-                                              extra={'user': request.user.username, 'module': edmodule.code})
-                    logging.error('User {} without active enrollment tried to unenroll from module {}'.format(
-                        request.user.username, edmodule.code
-                    ))
-                    return JsonResponse({'status': 1})
-                enr = EducationalModuleEnrollment.objects.create(
-                    user=request.user, module=edmodule, is_active=is_active
-                )
-                update_module_enrollment_progress(enr)
-                edmodule_enrolled.send(EducationalModuleEnrollment, instance=enr)
+                else:
+                    reporter.report('User without active enrollment tried to unenroll from module',
+                                    user=request.user.username, module=edmodule.code)
+                return JsonResponse({'status': 1})
+            if is_active:
+                _process_enrollment(enrollment)
             logging.info('User {} successfully {} educational module {}'.format(
                 request.user.username, 'enrolled in' if is_active else 'unenrolled from', edmodule.code
             ))
@@ -66,45 +84,114 @@ def edmodule_enroll(request):
     else:
         bad_ed_module_code = True
     if bad_ed_module_code:
-        if client:
-            client.captureMessage('Invalid module code', extra={
-                'user': request.user.username,
-                'ed_module_code': ed_module_code,
-            })
-        logging.error('Educational module "{}" not found'.format(ed_module_code))
+        reporter.report('Invalid module code', user=request.user.username, ed_module_code=ed_module_code)
     return JsonResponse({'status': 1})
 
 
+@instrument_view('module_page')
 def module_page(request, code):
     """
-    страница образовательного модуля
+    страница образовательного модуля; записи пользователя на ближайшие сессии курсов
+    для кнопок записи загружаются одним запросом
     """
-    module = get_object_or_404(EducationalModule, code=code)
+    module = get_object_or_404(EducationalModule.objects.prefetch_related('instructors_cache'), code=code)
+    courses = list(module.courses.select_related('university').prefetch_related(COURSE_SESSIONS))
+    preload_enroll_buttons(request, courses)
     return render(request, 'edmodule/edmodule_page.html', {
         'object': module,
-        'courses': module.courses.all(),
+        'courses': courses,
         'authenticated': request.user.is_authenticated(),
     })
 
 
+@instrument_view('module_catalog')
+@require_GET
+def module_catalog(request):
+    """
+    каталог образовательных модулей в json с постраничной навигацией по курсору.
+    Поддерживает условные запросы: при совпадении ETag ответ 304 отдается без обращения к бд
+    """
+    try:
+        cursor = max(int(request.GET.get('cursor', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', CATALOG_PAGE_SIZE)), 1), CATALOG_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'invalid cursor or limit'}, status=400)
+    version = catalog_version()
+    etag = quote_etag(hashlib.md5('{}:{}:{}'.format(version, cursor, limit)).hexdigest())
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and etag in [i.strip() for i in if_none_match.split(',')]:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(get_catalog_page_json(version, cursor, limit), content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    return response
+
+
+@instrument_view('get_honor_text')
 @require_POST
 @login_required
 def get_honor_text(request):
     course_id = request.POST.get('course_id')
-    split = course_id.split('/')
     honor_text = ''
-    if len(split) == 3:
-        session = get_object_or_404(CourseSession,
-                                    course__university__slug=split[0],
-                                    course__slug=split[1],
-                                    slug=split[2])
-        honor_text = HonorCode.objects.get_text_for_session(session)
+    if len(course_id.split('/')) == 3:
+        texts = get_honor_texts([course_id])
+        if course_id not in texts:
+            raise Http404
+        honor_text = texts[course_id]
     return JsonResponse({'honor_text': honor_text})
 
 
+@instrument_view('get_honor_texts_batch')
+@require_POST
+@login_required
+def get_honor_texts_batch(request):
+    """
+    тексты кодекса чести для нескольких сессий за один запрос; course_ids - список
+    или строка через запятую. Ненайденные сессии в ответ не попадают
+    """
+    course_ids = request.POST.getlist('course_ids')
+    if len(course_ids) == 1:
+        course_ids = course_ids[0].split(',')
+    course_ids = [i.strip() for i in course_ids if len(i.strip().split('/')) == 3][:HONOR_TEXTS_BATCH_LIMIT]
+    return JsonResponse({'honor_texts': get_honor_texts(course_ids)})
+
+
+@instrument_view('export_enrollments')
+@staff_member_required
+@require_GET
+def export_enrollments_view(request):
+    """
+    потоковая выгрузка записей на модули для персонала. Параметры: format (csv/jsonl), module
+    (можно несколько), from и to (ГГГГ-ММ-ДД), payment_type, after_id - продолжение выгрузки
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in FORMATS:
+        return JsonResponse({'error': 'invalid format'}, status=400)
+    try:
+        after_id = max(int(request.GET.get('after_id', 0)), 0)
+        date_from, date_to = [parse_date(request.GET[k]) if request.GET.get(k) else None for k in ('from', 'to')]
+    except ValueError:
+        return JsonResponse({'error': 'invalid after_id or date'}, status=400)
+    if request.GET.get('from') and date_from is None or request.GET.get('to') and date_to is None:
+        return JsonResponse({'error': 'invalid after_id or date'}, status=400)
+    lines = export_enrollments(fmt, module_codes=request.GET.getlist('module'), date_from=date_from,
+                               date_to=date_to, payment_type=request.GET.get('payment_type') or None,
+                               after_id=after_id)
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="edmodule_enrollments.{}"'.format(fmt)
+    return response
+
+
 def update_context_with_modules(context, user):
+    """
+    модули пользователя для блока course/b_modules.html; курсы и их вузы выбираются
+    заранее, чтобы число запросов не зависело от числа модулей и курсов
+    """
     if user.is_authenticated():
-        modules = EducationalModule.objects.filter(educationalmoduleenrollment__user=user).distinct().order_by('title')
+        modules = EducationalModule.objects.filter(educationalmoduleenrollment__user=user).distinct().order_by(
+            'title').prefetch_related(Prefetch('courses', queryset=Course.objects.select_related('university')))
     else:
         modules = EducationalModule.objects.none()
     context['modules'] = modules